@@ -1,373 +1,146 @@
-from skyfield.api import load, Topos
-from skyfield import almanac
-from skyfield.positionlib import position_of_radec
+import os
+import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
-from pytz import timezone
-import gradio as gr
-import matplotlib.pyplot as plt
-import numpy as np
-from PIL import Image
-import io
-import urllib.request
-
-# Load ephemeris data and timescale
-eph = load('de441.bsp')
-earth, moon, sun = eph['earth'], eph['moon'], eph['sun']
-ts = load.timescale()
-
-def get_moon_age_and_new_moon(time, utc_offset):
-    """Calculate Moon Age and Time of New Moon in local time."""
-    # Find the previous and next new moons
-    t0 = ts.utc(time.utc_datetime() - timedelta(days=30))
-    t1 = ts.utc(time.utc_datetime() + timedelta(days=30))
-    phases = almanac.moon_phases(eph)
-    times, events = almanac.find_discrete(t0, t1, phases)
-
-    # Filter for new moons (event == 0) and convert to UTC datetime for comparison
-    new_moons = [(t, t.utc_datetime()) for t, e in zip(times, events) if e == 0]
-    current_time = time.utc_datetime()
-
-    # Find the most recent new moon
-    previous_new_moon = max((t for t, dt in new_moons if dt <= current_time),
-                          key=lambda t: t.utc_datetime())
-
-    # Find the next new moon
-    next_new_moon = min((t for t, dt in new_moons if dt > current_time),
-                       key=lambda t: t.utc_datetime())
-
-    # Calculate Moon Age (time since last new moon)
-    moon_age_days = (time.tt - previous_new_moon.tt)
-
-    # Convert new moon times to local time
-    previous_new_moon_local = previous_new_moon.utc_datetime() + timedelta(hours=utc_offset)
-    next_new_moon_local = next_new_moon.utc_datetime() + timedelta(hours=utc_offset)
-
-    return moon_age_days, previous_new_moon_local, next_new_moon_local
-
-def compute_moon_sun_data(observer, time):
-    """Computes Moon and Sun data at the specified time."""
-    moon_astrometric = observer.at(time).observe(moon).apparent()
-    sun_astrometric = observer.at(time).observe(sun).apparent()
-    moon_alt, moon_az, _ = moon_astrometric.altaz()
-    sun_alt, sun_az, _ = sun_astrometric.altaz()
-
-    # Topocentric Elongation Calculation
-    topocentric_elongation = moon_astrometric.separation_from(sun_astrometric).degrees
-
-    # Geocentric Elongation Calculation
-    moon_geocentric = earth.at(time).observe(moon)
-    sun_geocentric = earth.at(time).observe(sun)
-    geocentric_elongation = moon_geocentric.separation_from(sun_geocentric).degrees
-
-    azimuth_diff = moon_az.degrees - sun_az.degrees
-    moon_ra, moon_dec, _ = moon_astrometric.radec()
-    sun_ra, sun_dec, _ = sun_astrometric.radec()
-
-    # Calculate Lama Hilal (duration of crescent moon visibility)
-    # Assuming 15 degrees per hour for the Earth's rotation
-    lama_hilal = moon_alt.degrees / 15  # moon_alt is already in degrees
-
-    # Calculate Cahaya (Moon's illumination percentage)
-    # Use Skyfield's illuminated function
-    cahaya = almanac.fraction_illuminated(eph, 'moon', time) * 100
-
-    # Convert Cahaya to Usbu'
-    cahaya_usbu = cahaya / 12.5  # Divide by 12.5 to get Usbu' value
-
-
-    # --- Moon Lag Time Calculation ---
-    # Get the Moon's right ascension and declination at the current time
-    moon_ra, moon_dec, _ = moon_astrometric.radec()  
-
-    # Calculate the Moon's position 24 hours earlier
-    time_24h_ago = time - timedelta(hours=24)
-    moon_astrometric_24h_ago = observer.at(time_24h_ago).observe(moon).apparent()
-    moon_ra_24h_ago, moon_dec_24h_ago, _ = moon_astrometric_24h_ago.radec()
-
-    # Calculate the difference in right ascension (in hours)
-    ra_diff_hours = (moon_ra.hours - moon_ra_24h_ago.hours) * 24  
-
-    # Moon lag time is the RA difference (positive value indicates lag)
-    moon_lag_time = ra_diff_hours  
-
-
-    return (moon_alt.degrees, sun_alt.degrees, topocentric_elongation, geocentric_elongation,
-            azimuth_diff, moon_ra, moon_dec, sun_ra, sun_dec, moon_az.degrees, sun_az.degrees, lama_hilal, cahaya, cahaya_usbu, moon_lag_time)
-
-def check_irnu_criteria(moon_alt, geocentric_elongation):
-    if moon_alt > 3 and geocentric_elongation > 6.4:
-        return ("✅ MEMENUHI KRITERIA IRNU\n"
-                "✅ Meets IRNU Criteria\n"
-                "✅ 符合 IRNU 标准\n"
-                "✅ يفي بمعايير IRNU")
-    else:
-        return ("❌ TIDAK MEMENUHI KRITERIA IRNU\n"
-                "❌ Does not meet IRNU Criteria\n"
-                "❌ 不符合 IRNU 标准\n"
-                "❌ لا يفي بمعايير IRNU")
-
-def get_cardinal_direction(azimuth):
-    """Converts azimuth degrees to a cardinal direction with icons."""
-    directions = {
-        "U": "⬆️ Utara",
-        "UTL": "↗️ Utara-Timur Laut",
-        "TL": "↗️ Timur Laut",
-        "TTL": "↗️ Timur-Timur Laut",
-        "T": "➡️ Timur",
-        "TTG": "↘️ Timur-Tenggara",
-        "TG": "↘️ Tenggara",
-        "STG": "↘️ Selatan-Tenggara",
-        "S": "⬇️ Selatan",
-        "SBD": "↙️ Selatan-Barat Daya",
-        "BD": "↙️ Barat Daya",
-        "BBD": "↙️ Barat-Barat Daya",
-        "B": "⬅️ Barat",
-        "BBL": "↖️ Barat-Barat Laut",
-        "BL": "↖️ Barat Laut",
-        "UBL": "↖️ Utara-Barat Laut"
-    }
-    index = int((azimuth + 11.25) / 22.5) % 16
-    return list(directions.values())[index]
-
-def create_visualization(moon_alt, sun_alt, moon_azimuth, sun_az, geocentric_elongation, year, month, day, hour, minute, day29, time_option):
-    """Creates the visualization plot with background image."""
-    try:
-        # Load background image
-        with urllib.request.urlopen('https://images.unsplash.com/photo-1535914728398-fcc06686536c?q=80&w=2954&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D') as url:
-            bg_img = Image.open(url)
-            bg_img = np.array(bg_img)
-
-        fig, ax = plt.subplots(figsize=(12, 6))
-
-        # Dynamically adjust background extent (Further Enhanced)
-        bg_extent = [
-            min(moon_azimuth, sun_az) - 15,
-            max(moon_azimuth, sun_az) + 15,
-            min(0, moon_alt, sun_alt) - 7,
-            max(0, moon_alt, sun_alt) + 7
-        ]
-
-
-        # Plot background
-        ax.imshow(bg_img, extent=bg_extent, aspect='auto', alpha=0.7)
-
-        # Plot Moon position
-        ax.plot(moon_azimuth, moon_alt, 'o', color='yellow', markersize=12, label='Bulan')
-        # ax.annotate('Bulan', (moon_azimuth, moon_alt),
-        #            textcoords="offset points", xytext=(10, 10),
-        #            ha='center', color='yellow', fontsize=12, weight='bold')
-
-        # Plot Sun position
-        ax.plot(sun_az, sun_alt, 'o', color='red', markersize=14, label='Matahari')  # Removed .degrees from sun_az
-        # ax.annotate('Matahari', (sun_az, sun_alt),  # Removed .degrees from sun_az
-        #            textcoords="offset points", xytext=(10, 10),
-        #            ha='center', color='red', fontsize=12, weight='bold')
-
-        # Horizon Line
-        ax.axhline(0, color='red', linestyle='-', linewidth=2)
-
-
-        # --- Geocentric Elongation Lines ---
-        if day29 == "Yes":  # Check if day29_input is "Yes"
-            # Line connecting Sun to Moon (existing)
-            ax.plot([sun_az, moon_azimuth], [sun_alt, moon_alt], '--',
-                    color='white', linewidth=1.5, label="Sudut Elongasi")
-            ax.text((sun_az + moon_azimuth) / 2, (sun_alt + moon_alt) / 2 + 1,
-                    f"{geocentric_elongation:.2f}°", color='white',
-                    ha='right', va='center', fontsize=10)
-
-            # Line connecting Earth to Moon (new)
-            # Calculate the endpoint coordinates
-            earth_line_end_x = moon_azimuth  # Earth azimuth = Moon azimuth
-            earth_line_end_y = 0  # Earth altitude = 0 (horizon)
-
-            # Draw the earth line
-            ax.plot([moon_azimuth, earth_line_end_x], [moon_alt, earth_line_end_y], '--',
-                    color='white', linewidth=1.5)
-            ax.text(moon_azimuth, moon_alt / 2 + 1, " ", color='lightblue', ha='center', va='center', fontsize=10)  # Placeholder for degree label
-
-            # Add helping lines with annotations
-            ax.axhline(3, color='orange', linestyle='--', label='Ketinggian Minimal Imkan')
-
-
-
-        # Set plot limits to match background extent
-        ax.set_xlim(bg_extent[0], bg_extent[1])
-        ax.set_ylim(bg_extent[2], bg_extent[3])
-
-        # Labels and styling
-        ax.set_xlabel('Azimuth (°)', fontsize=14, weight='bold', color='white')
-        ax.set_ylabel('Ketinggian/Altitude (°)', fontsize=14, weight='bold', color='white')
-
-        # Set the plot title based on time_option
-        if time_option.lower() == "current":
-            title = f'Moon and Sun Position (Current Time)'
-        elif time_option.lower() == "sunset":
-            title = f'Hilal saat Ghurub (Sunset)'
-            # title = f'Hilal saat Ghurub/'{time_label} {time_display.strftime('%Y-%m-%d %H:%M')}
-        else: # specific or any other case
-            title = f'Moon and Sun Position ({year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d})'
-
-        ax.set_title(title, fontsize=16, weight='bold', color='white')
-
-
-        # Customize grid and legend
-        ax.grid(True, linestyle='--', alpha=0.4, color='white')
-        ax.legend(facecolor='black', edgecolor='white', labelcolor='white')
-
-        # Style the axis labels
-        ax.tick_params(colors='white')
-        for spine in ax.spines.values():
-            spine.set_color('white')
-
-        # Save plot to buffer with transparent background
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight', dpi=300,
-                   facecolor='black', edgecolor='none')
-        buf.seek(0)
-        plt.close(fig)
-
-        return buf
-
-    except Exception as e:
-        print(f"Visualization error: {str(e)}")
-
+from metrics import format_startup_report, metrics_enabled, span, start_metrics_server, startup_phase
+with startup_phase("import gradio"):
+    import gradio as gr
+with startup_phase("import calculator"):
+    # The computations live in calculator.py; they are re-exported here for existing imports of app
+    from calculator import (ReportError, check_irnu_criteria, compute_moon_sun_data, compute_moon_sun_report,
+                            compute_moon_sun_values, format_report, get_cardinal_direction,
+                            get_moon_age_and_new_moon, resolve_location, search_new_moons)
+    from range_reports import (MAX_MAP_RESOLUTION, current_hijri_year, hijri_year_rows, map_summary, parse_date,
+                               sunset_rows, visibility_sweep)
+import pandas as pd
+from ephemeris_store import get_ephemeris, get_timescale
+from lunations import get_lunation_table
+from render_pool import RENDER_PROFILES, get_pool, open_image, render_image, render_map
+from result_cache import image_cache, report_ttl
+from snapshots import start_snapshot_refresher
+
+# Gradio queue: requests handled at once per event, and requests allowed to wait
+QUEUE_CONCURRENCY = int(os.environ.get('QUEUE_CONCURRENCY', 4))
+QUEUE_MAX_SIZE = int(os.environ.get('QUEUE_MAX_SIZE', 64))
+# Range reports handled at once; each keeps a CPU busy for seconds to minutes
+RANGE_CONCURRENCY = int(os.environ.get('RANGE_CONCURRENCY', 2))
+# Shortest interval between two partial results sent to the browser, in seconds
+RANGE_UPDATE_SECONDS = 0.5
+
+RANGE_TYPES = ["Sunsets", "Hijri year", "Visibility sweep"]
 
 def moon_sun_report(location_option, city, manual_lat, manual_lon,
-                    time_option, year, month, day, hour, minute, day29):
+                    time_option, year, month, day, hour, minute, day29, render_profile="export"):
     """Computes the Moon & Sun report using the chosen location and time."""
+    with span("report"):
+        report, plot_args, image_key = compute_moon_sun_report(location_option, city, manual_lat, manual_lon,
+                                                               time_option, year, month, day, hour, minute,
+                                                               day29, render_profile)
+    if plot_args is None:
+        return report, None
+    return report, open_image(cached_render(plot_args, render_profile, image_key, time_option))
+
+def moon_sun_report_stream(location_option, city, manual_lat, manual_lon,
+                           time_option, year, month, day, hour, minute, day29, render_profile="fast"):
+    """Yields the text report immediately, then again with the visualization once it is rendered."""
+    with span("report"):
+        report, plot_args, image_key = compute_moon_sun_report(location_option, city, manual_lat, manual_lon,
+                                                               time_option, year, month, day, hour, minute,
+                                                               day29, render_profile)
+    if plot_args is None:
+        yield report, None
+        return
+    # The text first, so that it is shown even if rendering fails
+    yield report, None
+    yield report, open_image(cached_render(plot_args, render_profile, image_key, time_option))
+
+def cached_render(plot_args, render_profile, image_key, time_option):
+    """Returns a Future of the encoded image, served from the image cache when possible."""
+    future = Future()
+    data = image_cache.get(image_key)
+    if data is not None:
+        future.set_result(data)
+        return future
+
+    def store(done):
+        if done.exception() is None and done.result() is not None:
+            image_cache.put(image_key, done.result(), ttl=report_ttl(time_option))
+
+    future = render_image(plot_args, render_profile)
+    future.add_done_callback(store)
+    return future
+
+def range_report_stream(range_type, location_option, city, manual_lat, manual_lon,
+                        start_date, end_date, hijri_year, map_resolution):
+    """Yields the progress, table, chart and map of a range report as its rows are finished.
+
+    Stopping the event closes this generator, which stops the computation.
+    """
     try:
-        # Initialize geolocator and timezone finder
-        geolocator = Nominatim(user_agent="Ephemiris Moon-Sun Calculator")
-        tf = TimezoneFinder()
-
-        # Determine location based on option
-        if location_option == "City":
-            location = geolocator.geocode(city)
-            if not location:
-                return "Location not found. Please check your city name.", None
-            latitude = location.latitude
-            longitude = location.longitude
-        else:  # Manual input
-            if manual_lat is None or manual_lon is None:
-                return "Please provide both latitude and longitude for manual input.", None
-            latitude = manual_lat
-            longitude = manual_lon
-
-        observer_location = Topos(latitude_degrees=latitude, longitude_degrees=longitude)
-        observer = earth + observer_location
-
-        # Get timezone information
-        timezone_str = tf.timezone_at(lng=longitude, lat=latitude)
-        if timezone_str:
-            local_tz = timezone(timezone_str)
-            sample_dt = datetime.now()
-            utc_offset = local_tz.utcoffset(sample_dt).total_seconds() / 3600
-        else:
-            timezone_str = "Unknown"
-            utc_offset = 8  # default if not found
-        tz_info = f"{timezone_str} (UTC+{utc_offset:.0f})"
-
-        # Determine the time based on time option
-        if time_option.lower() == "sunset":
-            t0 = ts.utc(year, month, day)
-            t1 = ts.utc(year, month, day + 1)
-            f = almanac.sunrise_sunset(eph, observer_location)
-            t, y = almanac.find_discrete(t0, t1, f)
-            if len(t[y == 0]) == 0:
-                return "Sunset not found for the given date at this location.", None
-            time_obj = t[y == 0][0]  # sunset time
-            time_label = "(sunset)"
-            time_display = time_obj.utc_datetime() + timedelta(hours=utc_offset)
-            sunset_time = t[y == 0][0] # Store sunset time here         
-        elif time_option.lower() == "specific":
-            user_time = datetime(year, month, day, hour, minute)
-            utc_time = user_time - timedelta(hours=utc_offset)
-            time_obj = ts.utc(utc_time.year, utc_time.month, utc_time.day, utc_time.hour, utc_time.minute)
-            time_label = "(Local Time)"
-            time_display = user_time
-        else:  # current
-            time_obj = ts.now()
-            time_label = "(Current Time)"
-            time_display = time_obj.utc_datetime() + timedelta(hours=utc_offset)
-
-        # Compute Moon and Sun positions
-        (moon_alt, sun_alt, topocentric_elongation, geocentric_elongation,
-         azimuth_diff, moon_ra, moon_dec, sun_ra, sun_dec, moon_azimuth, sun_azimuth, lama_hilal, cahaya, cahaya_usbu, moon_lag_time) = compute_moon_sun_data(observer, time_obj)
-
-        # Generate visualization
-        plot_buffer = create_visualization(moon_alt, sun_alt, moon_azimuth, sun_azimuth,
-                                         geocentric_elongation, year, month, day,
-                                         hour, minute, day29, time_option)
-
-        cardinal_direction = get_cardinal_direction(moon_azimuth)
-
-        # Calculate Moon Age and New Moon Time
-        moon_age_days, previous_new_moon_local, next_new_moon_local = get_moon_age_and_new_moon(time_obj, utc_offset)
-        moon_age_hours = moon_age_days * 24
-        moon_age_days_int = int(moon_age_hours // 24)
-        moon_age_hours_rem = moon_age_hours % 24
-
-                # --- Moon Lag Time Calculation (from sunset) ---
-        if time_option.lower() == "sunset": 
-            # Calculate Moon position at sunset
-            moon_astrometric_sunset = observer.at(sunset_time).observe(moon).apparent()
-            moon_ra_sunset, _, _ = moon_astrometric_sunset.radec()
-
-            # Calculate Moon position 24 hours before sunset
-            time_24h_before_sunset = sunset_time - timedelta(hours=24)
-            moon_astrometric_24h_before = observer.at(time_24h_before_sunset).observe(moon).apparent()
-            moon_ra_24h_before, _, _ = moon_astrometric_24h_before.radec()
-
-            # Calculate the difference in right ascension (in hours)
-            ra_diff_hours = (moon_ra_sunset.hours - moon_ra_24h_before.hours) * 24
-
-            # Moon lag time is the RA difference (positive value indicates lag)
-            moon_lag_time = ra_diff_hours 
-
-
-        # Build the report string
-        report = "----- Laporan Posisi Bulan dan Matahari -----\n"
-        report += f"Tanggal dan Waktu: {time_display.strftime('%Y-%m-%d %H:%M')} {time_label}\n"
-        if location_option == "City":
-            report += f"Lokasi Pengamat: Kota: {city}\n"
+        if range_type == "Visibility sweep":
+            yield from visibility_sweep_stream(parse_date(start_date), parse_date(end_date), int(map_resolution))
+            return
+        latitude, longitude = resolve_location(location_option, city, manual_lat, manual_lon)
+        label = city if location_option == "City" else f"{latitude:.4f},{longitude:.4f}"
+        if range_type == "Hijri year":
+            rows = hijri_year_rows(label, latitude, longitude, int(hijri_year))
+            yield from table_stream(rows, 12, 'observation_date')
         else:
-            report += f"Lokasi Pengamat: Manual: (Lintang: {latitude:.4f}, Bujur: {longitude:.4f})\n"
-        report += f"Zona Waktu: {tz_info}\n\n"
-        report += f"🌙 Umur Bulan: {moon_age_days_int} hari {moon_age_hours_rem:.2f} jam (sejak bulan baru terakhir)\n"
-        report += f"🌑 Bulan Baru Sebelumnya: {previous_new_moon_local.strftime('%Y-%m-%d %H:%M')} Waktu Setempat\n"
-        report += f"🌑 Bulan Baru Berikutnya: {next_new_moon_local.strftime('%Y-%m-%d %H:%M')} Waktu Setempat\n\n"
-        report += f"🌙 Ketinggian Bulan: {moon_alt:.2f}°\n"
-        if time_option.lower() == "sunset": # Add condition to display Moon Lag Time only for sunset
-          report += f"🌙 Moon Lag Time: {moon_lag_time:.2f} hours\n" # Add this line
-
-        # report += f"🌙 Lama Hilal (Visibility Duration): {lama_hilal:.2f} hours\n"
-        report += f"🌙 Cahaya: {cahaya:.2f}% ({cahaya_usbu:.2f} Usbu')\n"
-        report += f"☀ Azimuth Matahari: {sun_azimuth:.2f}°\n" 
-        report += f"☀ Ketinggian Matahari: {sun_alt:.2f}°\n"
-        report += f"🔭 Elongasi Topocentric Bulan-Matahari: {topocentric_elongation:.2f}°\n"
-        report += f"🔭 Elongasi Geosentris Bulan-Matahari: {geocentric_elongation:.2f}°\n"
-        report += f"🧭 Azimuth Bulan: {moon_azimuth:.2f}° ({cardinal_direction})\n"
-        report += f"🧭 Perbedaan Azimuth Bulan dan Matahari: {azimuth_diff:.2f}°\n\n"
-        report += f"Asensio Rekta Bulan: {moon_ra.hms()}\n"
-        report += f"Deklinasi Bulan: {moon_dec.dms()}\n"
-        report += f"Asensio Rekta Matahari: {sun_ra.hms()}\n"
-        report += f"Deklinasi Matahari: {sun_dec.dms()}\n\n"
-
-        if day29 == "Yes":
-            report += "----------------------------------------\n"
-            report += "Note:\n1. IRNU criteria are primarily applicable on the 29th day of the Hijri calendar.\n2. These criteria serve as a reference only.\n3. Using these criteria on days other than the 29th is not recommended.\n4. Local sighting and other factors are crucial for determining the start of a new lunar month.\n\n"
-            report += check_irnu_criteria(moon_alt, geocentric_elongation)
-
-        if plot_buffer is None:
-            return report, None
-
-        return report, Image.open(plot_buffer)
-
-    except Exception as e:
-        return f"An error occurred: {str(e)}", None
+            start, end = parse_date(start_date), parse_date(end_date)
+            yield from table_stream(sunset_rows(latitude, longitude, start, end), (end - start).days + 1, 'date')
+    except ReportError as e:
+        yield str(e), None, None, None
+
+def table_stream(rows, total, date_field):
+    """Yields the rows finished so far, sorted by date, with a chart of Moon altitude and elongation."""
+    finished = []
+    last_update = 0
+    for row in rows:
+        finished.append(row)
+        if len(finished) < total and time.perf_counter() - last_update < RANGE_UPDATE_SECONDS:
+            continue
+        last_update = time.perf_counter()
+        table = pd.DataFrame(finished).sort_values(date_field, ignore_index=True)
+        chart = table.melt(id_vars=[date_field], value_vars=['moon_alt', 'geocentric_elongation'],
+                           var_name='quantity', value_name='value').rename(columns={date_field: 'date'})
+        chart['date'] = pd.to_datetime(chart['date'])
+        yield f"{len(finished)} / {total} rows", table, chart, None
+
+def visibility_sweep_stream(start, end, resolution):
+    """Yields the summary table, chart and latest map of a visibility sweep, coarse maps first."""
+    summaries = {}
+    yield "Computing the first maps...", None, None, None
+    for day, level, grid in visibility_sweep(start, end, resolution):
+        summaries[day] = map_summary(day, level, grid)
+        title = f'Visibilitas Hilal IRNU saat Ghurub {day.isoformat()} (H3 resolusi {level})'
+        future = cached_map(grid, title, ('visibility_map', day.toordinal(), level))
+        table = pd.DataFrame([summaries[d] for d in sorted(summaries)])
+        chart = pd.DataFrame({'date': pd.to_datetime(table['date']), 'quantity': 'met_percent',
+                              'value': table['met_percent']})
+        yield (f"Resolution {level} of {resolution}: {day.isoformat()}, "
+               f"{summaries[day]['met_percent']}% of the cells meet the IRNU criteria"), table, chart, open_image(future)
+
+def cached_map(grid, title, image_key):
+    """Returns a Future of the rendered visibility map, served from the image cache when possible."""
+    future = Future()
+    data = image_cache.get(image_key)
+    if data is not None:
+        future.set_result(data)
+        return future
+
+    def store(done):
+        if done.exception() is None:
+            image_cache.put(image_key, done.result())
+
+    future = render_map(grid, title)
+    future.add_done_callback(store)
+    return future
+
+def update_range_fields(range_type):
+    """Shows the inputs used by the selected kind of range."""
+    dates = range_type != "Hijri year"
+    return (gr.update(visible=dates), gr.update(visible=dates), gr.update(visible=not dates),
+            gr.update(visible=range_type == "Visibility sweep"))
 
 def update_time_fields(time_option):
     """Update visibility of time fields based on the selected time option."""
@@ -385,79 +158,167 @@ def update_location_fields(location_option):
     else:  # Manual
         return gr.update(visible=False), gr.update(visible=True), gr.update(visible=True)
 
-# Create the Gradio interface
-with gr.Blocks() as demo:
-    gr.Markdown("# Moon and Sun Position Calculator | Supervised by LFNU Taiwan")
-    gr.Markdown("Enter a location and time option to compute the Moon and Sun positions along with IRNU criteria and timezone information.")
+def build_demo():
+    """Creates the Gradio interface."""
+    with gr.Blocks() as demo:
+        gr.Markdown("# Moon and Sun Position Calculator | Supervised by LFNU Taiwan")
+        gr.Markdown("Enter a location and time option to compute the Moon and Sun positions along with IRNU criteria and timezone information.")
+
+        with gr.Row():
+            location_option_input = gr.Radio(
+                choices=["City", "Manual"],
+                label="Location Option",
+                value="City"
+            )
+
+        with gr.Row():
+            city_input = gr.Textbox(label="City", placeholder="Enter a city name")
+            lat_input = gr.Number(label="Latitude", value=25.0494, visible=False)
+            lon_input = gr.Number(label="Longitude", value=121.5198, visible=False)
+
+
+        with gr.Row():
+            with gr.Column():
+                time_option_input = gr.Radio(
+                    choices=["current", "sunset", "specific"],
+                    label="Time Option",
+                    value="current"
+                )
+            with gr.Column():
+                day29_input = gr.Radio(
+                    choices=["Yes", "No"],
+                    label="Is it day 29 in the Hijri calendar, and are you calculating the new month?",
+                    value="No"
+                )
+
+        with gr.Row():
+            year_input = gr.Number(label="Year", value=datetime.now().year, visible=False)
+            month_input = gr.Number(label="Month", value=datetime.now().month, visible=False)
+            day_input = gr.Number(label="Day", value=datetime.now().day, visible=False)
+
+        with gr.Row():
+            hour_input = gr.Number(label="Hour (24-hour format)", value=datetime.now().hour, visible=False)
+            minute_input = gr.Number(label="Minute", value=datetime.now().minute, visible=False)
+
+        with gr.Row():
+            render_profile_input = gr.Radio(
+                choices=list(RENDER_PROFILES),
+                label="Visualization Quality (fast for viewing, export for high-resolution PNG)",
+                value="fast"
+            )
 
-    with gr.Row():
-        location_option_input = gr.Radio(
-            choices=["City", "Manual"],
-            label="Location Option",
-            value="City"
+        with gr.Row():
+            submit_btn = gr.Button("Calculate")
+
+        with gr.Row():
+            with gr.Column():
+              output_text = gr.Textbox(label="Celestial data courtesy of NASA JPL DE441.bsp ephemeris.", lines=20)
+            with gr.Column():
+              output_plot = gr.Image(label="Visualization")
+
+        # Connect all the event handlers
+        location_option_input.change(
+            fn=update_location_fields,
+            inputs=location_option_input,
+            outputs=[city_input, lat_input, lon_input]
         )
 
-    with gr.Row():
-        city_input = gr.Textbox(label="City", placeholder="Enter a city name")
-        lat_input = gr.Number(label="Latitude", value=25.0494, visible=False)
-        lon_input = gr.Number(label="Longitude", value=121.5198, visible=False)
+        time_option_input.change(
+            fn=update_time_fields,
+            inputs=time_option_input,
+            outputs=[year_input, month_input, day_input, hour_input, minute_input]
+        )
 
+        submit_btn.click(
+            fn=moon_sun_report_stream,
+            inputs=[
+                location_option_input, city_input, lat_input, lon_input,
+                time_option_input, year_input, month_input, day_input,
+                hour_input, minute_input, day29_input, render_profile_input
+            ],
+            outputs=[output_text, output_plot]
+        )
 
-    with gr.Row():
-        with gr.Column():
-            time_option_input = gr.Radio(
-                choices=["current", "sunset", "specific"],
-                label="Time Option",
-                value="current"
-            )
-        with gr.Column():
-            day29_input = gr.Radio(
-                choices=["Yes", "No"],
-                label="Is it day 29 in the Hijri calendar, and are you calculating the new month?",
-                value="No"
+        gr.Markdown("## Date Ranges")
+        gr.Markdown("Sunsets over a range of dates or the month starts of a Hijri year at the location above, or the global IRNU visibility map over a few evenings. Rows appear as they are computed, and rows computed before are reused.")
+
+        with gr.Row():
+            range_type_input = gr.Radio(
+                choices=RANGE_TYPES,
+                label="Range",
+                value=RANGE_TYPES[0]
             )
 
-    with gr.Row():
-        year_input = gr.Number(label="Year", value=datetime.now().year, visible=False)
-        month_input = gr.Number(label="Month", value=datetime.now().month, visible=False)
-        day_input = gr.Number(label="Day", value=datetime.now().day, visible=False)
-
-    with gr.Row():
-        hour_input = gr.Number(label="Hour (24-hour format)", value=datetime.now().hour, visible=False)
-        minute_input = gr.Number(label="Minute", value=datetime.now().minute, visible=False)
-
-    with gr.Row():
-        submit_btn = gr.Button("Calculate")
-
-    with gr.Row():
-        with gr.Column():
-          output_text = gr.Textbox(label="Celestial data courtesy of NASA JPL DE441.bsp ephemeris.", lines=20)
-        with gr.Column():
-          output_plot = gr.Image(label="Visualization")
-
-    # Connect all the event handlers
-    location_option_input.change(
-        fn=update_location_fields,
-        inputs=location_option_input,
-        outputs=[city_input, lat_input, lon_input]
-    )
-
-    time_option_input.change(
-        fn=update_time_fields,
-        inputs=time_option_input,
-        outputs=[year_input, month_input, day_input, hour_input, minute_input]
-    )
-
-    submit_btn.click(
-        fn=moon_sun_report,
-        inputs=[
-            location_option_input, city_input, lat_input, lon_input,
-            time_option_input, year_input, month_input, day_input,
-            hour_input, minute_input, day29_input
-        ],
-        outputs=[output_text, output_plot]
-    )
-
-    gr.Markdown("<center>Copyright © 2025 @ainulyaqinmhd | All Rights Reserved.</center>")
-
-demo.launch()
\ No newline at end of file
+        first_day = datetime.now().date().replace(day=1)
+        last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        with gr.Row():
+            start_date_input = gr.Textbox(label="From (YYYY-MM-DD)", value=first_day.isoformat())
+            end_date_input = gr.Textbox(label="To (YYYY-MM-DD)", value=last_day.isoformat())
+            hijri_year_input = gr.Number(label="Hijri Year", value=current_hijri_year(), visible=False)
+            map_resolution_input = gr.Slider(0, MAX_MAP_RESOLUTION, value=2, step=1, visible=False,
+                                             label="Map Detail (H3 resolution; 3 takes minutes per evening)")
+
+        with gr.Row():
+            range_btn = gr.Button("Compute Range")
+            stop_btn = gr.Button("Stop")
+
+        range_status = gr.Textbox(label="Progress")
+        range_table = gr.Dataframe(label="Results", wrap=True)
+        with gr.Row():
+            with gr.Column():
+                range_chart = gr.LinePlot(x="date", y="value", color="quantity", label="Chart",
+                                          tooltip=["date", "quantity", "value"])
+            with gr.Column():
+                range_map = gr.Image(label="Visibility Map")
+
+        range_type_input.change(
+            fn=update_range_fields,
+            inputs=range_type_input,
+            outputs=[start_date_input, end_date_input, hijri_year_input, map_resolution_input]
+        )
+
+        range_event = range_btn.click(
+            fn=range_report_stream,
+            inputs=[
+                range_type_input, location_option_input, city_input, lat_input, lon_input,
+                start_date_input, end_date_input, hijri_year_input, map_resolution_input
+            ],
+            outputs=[range_status, range_table, range_chart, range_map],
+            concurrency_limit=RANGE_CONCURRENCY
+        )
+        stop_btn.click(fn=None, cancels=[range_event])
+
+        gr.Markdown("<center>Copyright © 2025 @ainulyaqinmhd | All Rights Reserved.</center>")
+
+    # Bounded concurrency: long requests wait in the queue instead of starving the short ones
+    return demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY, max_size=QUEUE_MAX_SIZE)
+
+def __getattr__(name):
+    # `demo` is built on first access, for tools that import it from this module
+    if name == "demo":
+        global demo
+        demo = build_demo()
+        return demo
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+if __name__ == "__main__":
+    # Open the heavy resources now, timing each phase, so the first request does not wait for them
+    with startup_phase("ephemeris"):
+        get_ephemeris()
+    with startup_phase("timescale"):
+        get_timescale()
+    with startup_phase("lunation table"):
+        get_lunation_table()
+    with startup_phase("render pool"):
+        # Start and warm up every worker now rather than on the first renders
+        get_pool(wait_ready=True)
+    with startup_phase("snapshots"):
+        # Keeps "current" positions of the popular places fresh in the background
+        start_snapshot_refresher()
+    with startup_phase("build interface"):
+        demo = build_demo()
+    print(format_startup_report())
+    if metrics_enabled():
+        server = start_metrics_server()
+        print(f"Metrics at http://localhost:{server.server_address[1]}/metrics")
+    demo.launch()
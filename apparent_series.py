@@ -0,0 +1,234 @@
+"""Chebyshev series of the apparent geocentric Moon and Sun.
+
+Batch work evaluates the full ephemeris chain (light time, deflection,
+aberration) for the same Moon and Sun instants once per observer.  This
+module fits, once for a range of dates, Chebyshev polynomials to the
+apparent geocentric GCRS position vectors of both bodies (and to the
+astrometric ones, for the geocentric elongation and illumination, which
+the scalar path computes without aberration), checks the fit
+against the ephemeris between the fitting nodes, and stores the
+coefficients as a small array file that is memory-mapped and shared by
+every worker.  Topocentric positions are then the geocentric ones minus the
+observer's geocentric position (parallax), which needs no ephemeris at all.
+The nutation angles, the costly part of the Earth's orientation, are fitted
+the same way and preset on the Skyfield times used for the observers.
+
+Build a series for the years you need with:
+
+    python apparent_series.py --start 2020 --end 2035
+"""
+import argparse
+import os
+from functools import lru_cache
+
+import numpy as np
+from numpy.polynomial import chebyshev
+from skyfield.api import Topos
+from skyfield.functions import angle_between, mxv, to_spherical
+from skyfield.nutationlib import iau2000a_radians
+
+from ephemeris_store import ephemeris_year_range, get_ephemeris, get_timescale
+
+APPARENT_SERIES = os.environ.get('APPARENT_SERIES_PATH', 'apparent_series.npy')
+
+BODIES = ('moon', 'sun')
+# Fitted vectors per body: apparent (topocentric positions) and astrometric (geocentric elongation, illumination)
+FRAMES = ('', '_astrometric')
+
+# Length of each fitted interval in days and the degree of the polynomials;
+# with these the fit stays within about 0.1 milliarcseconds (about 15 MB per 200 years)
+INTERVAL_DAYS = 8
+DEGREE = 13
+# Extra evaluations per interval, between the nodes, used to measure the fit error
+CHECK_POINTS = 16
+
+AU_KM = 149597870.7
+
+
+def series_dtype(degree):
+    """One record per interval: its TT bounds, per body the apparent and astrometric x/y/z
+    coefficients (au), the nutation coefficients (radians), and the largest fit errors found (arcseconds)."""
+    fields = [('tt0', '<f8'), ('tt1', '<f8')]
+    for body in BODIES:
+        for frame in FRAMES:
+            fields += [(body + frame, '<f8', (3, degree + 1)), (f'{body}{frame}_error', '<f4')]
+    fields += [('nutation', '<f8', (2, degree + 1)), ('nutation_error', '<f4')]
+    return np.dtype(fields)
+
+
+def _apparent_positions(eph, ts, body, tt):
+    """Apparent geocentric GCRS position vectors (au) of `body`, shape (3, N)."""
+    return eph['earth'].at(ts.tt_jd(tt)).observe(eph[body]).apparent().position.au
+
+
+def _astrometric_positions(eph, ts, name, tt):
+    """Astrometric geocentric GCRS position vectors (au) of the body of `name`, shape (3, N)."""
+    return eph['earth'].at(ts.tt_jd(tt)).observe(eph[name.replace('_astrometric', '')]).position.au
+
+
+def _nutation_angles(eph, ts, name, tt):
+    """IAU 2000A nutation in longitude and obliquity (radians), shape (2, N)."""
+    return np.array(iau2000a_radians(ts.tt_jd(tt)))
+
+
+def _clenshaw(coefficients, x):
+    """Evaluates Chebyshev series with coefficients (N, 3, D+1) at x (N), giving (3, N)."""
+    b1 = np.zeros(coefficients.shape[:2])
+    b2 = np.zeros_like(b1)
+    x = x[:, None]
+    for k in range(coefficients.shape[2] - 1, 0, -1):
+        b1, b2 = 2 * x * b1 - b2 + coefficients[:, :, k], b1
+    return (x * b1 - b2 + coefficients[:, :, 0]).T
+
+
+def build_apparent_series(eph, ts, start_year, end_year, interval_days=INTERVAL_DAYS, degree=DEGREE):
+    """Fits the series from the start of `start_year` to the end of `end_year`.
+
+    Returns the records, each carrying the largest error of its fit.
+    """
+    tt_start = ts.utc(start_year, 1, 1).tt
+    tt_end = ts.utc(end_year + 1, 1, 1).tt
+    count = int(np.ceil((tt_end - tt_start) / interval_days))
+
+    records = np.zeros(count, dtype=series_dtype(degree))
+    records['tt0'] = tt_start + interval_days * np.arange(count)
+    records['tt1'] = records['tt0'] + interval_days
+
+    # Chebyshev nodes, and check points spread between them
+    nodes = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    checks = np.linspace(-1, 1, CHECK_POINTS)
+    half = interval_days / 2
+    midpoints = records['tt0'] + half
+    for name, evaluate in [('moon', _apparent_positions), ('sun', _apparent_positions),
+                           ('moon_astrometric', _astrometric_positions), ('sun_astrometric', _astrometric_positions),
+                           ('nutation', _nutation_angles)]:
+        tt = (midpoints[:, None] + half * nodes[None, :]).ravel()
+        values = evaluate(eph, ts, name, tt)
+        axes = len(values)
+        # One least-squares fit for every interval and axis at once
+        samples = values.reshape(axes, count, degree + 1).transpose(2, 1, 0).reshape(degree + 1, count * axes)
+        coefficients = chebyshev.chebfit(nodes, samples, degree)
+        records[name] = coefficients.reshape(degree + 1, count, axes).transpose(1, 2, 0)
+
+        tt = (midpoints[:, None] + half * checks[None, :]).ravel()
+        expected = evaluate(eph, ts, name, tt)
+        fitted = _clenshaw(np.repeat(records[name], CHECK_POINTS, axis=0), np.tile(checks, count))
+        if name == 'nutation':
+            error = np.degrees(np.abs(expected - fitted).max(axis=0)) * 3600
+        else:
+            error = np.degrees(angle_between(expected, fitted)) * 3600
+        records[f'{name}_error'] = error.reshape(count, CHECK_POINTS).max(axis=1)
+    return records
+
+
+class ApparentSeries:
+    """Evaluates fitted apparent positions (all times are TT Julian dates)."""
+
+    def __init__(self, records):
+        self.records = records
+        self.start_tt = float(records['tt0'][0])
+        self.end_tt = float(records['tt1'][-1])
+        self.interval_days = float(records['tt1'][0] - records['tt0'][0])
+
+    def covers(self, tt):
+        """True when every instant of `tt` lies inside the fitted range."""
+        tt = np.asarray(tt)
+        return bool(np.all((tt >= self.start_tt) & (tt < self.end_tt)))
+
+    def max_error(self, name):
+        """Largest fit error of a body (or of 'nutation') over the whole range, in arcseconds."""
+        return float(self.records[f'{name}_error'].max())
+
+    def _evaluate(self, name, tt):
+        tt = np.atleast_1d(np.asarray(tt, dtype=float))
+        i = ((tt - self.start_tt) // self.interval_days).astype(int)
+        x = 2 * (tt - self.records['tt0'][i]) / self.interval_days - 1
+        return _clenshaw(self.records[name][i], x)
+
+    def geocentric(self, body, tt, astrometric=False):
+        """Apparent (or astrometric) geocentric GCRS position vectors (au) of `body` at `tt`, shape (3, N)."""
+        return self._evaluate(body + '_astrometric' if astrometric else body, tt)
+
+    def nutation(self, tt):
+        """Nutation in longitude and obliquity (radians) at `tt`, shape (2, N)."""
+        return self._evaluate('nutation', tt)
+
+
+def observer_frame(latitudes, longitudes, elevations, t, series=None):
+    """The observers' geocentric GCRS positions (au) and their GCRS-to-horizon rotations.
+
+    With a series, the nutation angles are taken from it, as Skyfield allows
+    for substituting a cheaper nutation model.
+    """
+    if series is not None:
+        # Private in Skyfield: a @reify attribute of Time in skyfield==1.45 (requirements.txt),
+        # so setting it first replaces the IAU 2000A computation; check it when upgrading Skyfield
+        t._nutation_angles_radians = tuple(series.nutation(t.tt))
+    topos = Topos(latitude_degrees=latitudes, longitude_degrees=longitudes, elevation_m=elevations)
+    return topos.at(t).position.au, topos.rotation_at(t)
+
+
+def horizontal(vector, rotation):
+    """Altitude and azimuth (degrees) and distance (au) of topocentric GCRS vectors."""
+    distance, alt, az = to_spherical(mxv(rotation, vector))
+    return np.degrees(alt), np.degrees(az), distance
+
+
+def radec(vector):
+    """Right ascension (hours) and declination (degrees) of GCRS vectors."""
+    _, dec, ra = to_spherical(vector)
+    return np.degrees(ra) / 15, np.degrees(dec)
+
+
+def separation(a, b):
+    """Angle between vectors, in degrees."""
+    return np.degrees(angle_between(a, b))
+
+
+def fraction_illuminated(moon, sun):
+    """Illuminated fraction of the Moon (0-1) from geocentric Moon and Sun vectors.
+
+    As in Skyfield's almanac, the phase angle is the Moon's angle from the
+    anti-Sun direction seen from the Earth's center.
+    """
+    return (1 + np.cos(angle_between(moon, -sun))) / 2
+
+
+def save_apparent_series(records, path=APPARENT_SERIES):
+    np.save(path, records)
+
+
+@lru_cache(maxsize=None)
+def load_apparent_series(path=APPARENT_SERIES):
+    """Memory-maps a saved series, or returns None if there is none."""
+    if not path or not os.path.exists(path):
+        return None
+    records = np.load(path, mmap_mode='r')
+    if 'moon_astrometric' not in records.dtype.names:
+        raise ValueError(f"{path} has no astrometric vectors; rebuild it with apparent_series.py")
+    return ApparentSeries(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit Chebyshev series to the apparent Moon and Sun.")
+    parser.add_argument('output', nargs='?', default=APPARENT_SERIES, help="path of the .npy series")
+    parser.add_argument('--start', type=int, required=True, help="first year")
+    parser.add_argument('--end', type=int, required=True, help="last year")
+    parser.add_argument('--interval', type=float, default=INTERVAL_DAYS, help="days per fitted interval")
+    parser.add_argument('--degree', type=int, default=DEGREE, help="degree of the polynomials")
+    args = parser.parse_args(argv)
+
+    eph = get_ephemeris()
+    first_year, last_year = ephemeris_year_range(eph)
+    start_year, end_year = max(args.start, first_year), min(args.end, last_year)
+    records = build_apparent_series(eph, get_timescale(), start_year, end_year, args.interval, args.degree)
+    save_apparent_series(records, args.output)
+    series = ApparentSeries(records)
+    print(f"{args.output}: {len(records)} intervals from {start_year} through {end_year}, "
+          f"{records.nbytes / 1e6:.1f} MB; largest error "
+          + ", ".join(f"{name} {series.max_error(name) * 1000:.2f} mas"
+                      for name in [body + frame for body in BODIES for frame in FRAMES] + ['nutation']))
+
+
+if __name__ == '__main__':
+    main()
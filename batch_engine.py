@@ -0,0 +1,226 @@
+"""Vectorized Moon and Sun calculations for many observers and times at once.
+
+`compute_moon_sun_batch` evaluates N observers x M times in a single pass:
+every (observer, time) pair is flattened into one Skyfield vector, so each
+position is computed once per pair, and the geocentric quantities, which do
+not depend on the observer, are computed once per time.
+`compute_moon_sun_pairs` does the same for N observers each at its own time.
+With `moonsets=True`, the moonset used for the lag time is solved from the
+Moon's position already computed at each instant, rather than from extra
+observations; otherwise the moonset fields are NaN.
+`compute_altitude_curves` samples the Moon and Sun altitudes between two
+instants per observer, e.g. from sunset to moonset.
+Optionally, positions come from a precomputed apparent_series fit.
+"""
+import numpy as np
+from skyfield import almanac
+from skyfield.api import Topos
+
+from apparent_series import AU_KM, fraction_illuminated, horizontal, observer_frame, radec, separation
+from ephemeris_store import get_ephemeris, get_timescale
+from metrics import count
+from rise_set import moon_events, moon_horizon
+
+# Names of the arrays returned by compute_moon_sun_batch, the first 15 in the
+# order of calculator.compute_moon_sun_data.  RA values are in hours, everything
+# else in degrees except cahaya (percent), cahaya_usbu, lama_hilal/moon_lag_time
+# (hours), moonset_tt (TT Julian date) and moon_distance (km).  lama_hilal,
+# moon_lag_time and moonset_tt are NaN unless moonsets are requested.
+BATCH_FIELDS = (
+    'moon_alt', 'sun_alt', 'topocentric_elongation', 'geocentric_elongation',
+    'azimuth_diff', 'moon_ra', 'moon_dec', 'sun_ra', 'sun_dec', 'moon_az', 'sun_az',
+    'lama_hilal', 'cahaya', 'cahaya_usbu', 'moon_lag_time', 'moonset_tt', 'moon_distance',
+)
+
+# IRNU thresholds in degrees
+IRNU_MIN_MOON_ALT = 3
+IRNU_MIN_ELONGATION = 6.4
+
+
+def _time_grid(times, repeats):
+    """Returns `times` (M) tiled `repeats` times, keeping the full two-part precision."""
+    whole = np.atleast_1d(times.whole)
+    fraction = np.atleast_1d(times.tt_fraction)
+    return times.ts.tt_jd(np.tile(whole, repeats), np.tile(fraction, repeats))
+
+
+def _as_array(values, like=None):
+    if values is None:
+        return np.zeros_like(like)
+    return np.atleast_1d(np.asarray(values, dtype=float))
+
+
+def _moonsets(latitudes, longitudes, elevations, tt, moon_alt, moon_az, moon_distance_km, series=None):
+    """Moonset nearest each instant: the next one while the Moon is up, the last one once it has set."""
+    moonset_tt = np.full(len(tt), np.nan)
+    # Up or down with respect to the same horizon rise_set solves moonsets for
+    up = moon_alt > moon_horizon(moon_distance_km)
+    if up.any():
+        moonset_tt[up] = moon_events(latitudes[up], longitudes[up], tt[up], elevations=elevations[up],
+                                     moon_alt=moon_alt[up], moon_az=moon_az[up], series=series)
+    down = ~up
+    if down.any():
+        previous = moon_events(latitudes[down], longitudes[down], tt[down] - 1, elevations=elevations[down],
+                               series=series)
+        moonset_tt[down] = np.where(previous <= tt[down], previous, np.nan)
+    return moonset_tt
+
+
+def _topocentric_fields(latitudes, longitudes, elevations, t, series=None, moonsets=False):
+    """Observer-dependent quantities for each (observer, time) pair, as flat arrays."""
+    if series is not None and series.covers(t.tt):
+        # Fitted geocentric positions with the observer's parallax removed
+        position, rotation = observer_frame(latitudes, longitudes, elevations, t, series)
+        moon_vector = series.geocentric('moon', t.tt) - position
+        sun_vector = series.geocentric('sun', t.tt) - position
+        moon_alt, moon_az, moon_distance = horizontal(moon_vector, rotation)
+        moon_distance_km = moon_distance * AU_KM
+        sun_alt, sun_az, _ = horizontal(sun_vector, rotation)
+        moon_ra, moon_dec = radec(moon_vector)
+        sun_ra, sun_dec = radec(sun_vector)
+        topocentric_elongation = separation(moon_vector, sun_vector)
+        count('positions_total', 2 * len(latitudes), body='moon_sun', source='series')
+    else:
+        eph = get_ephemeris()
+        earth, moon, sun = eph['earth'], eph['moon'], eph['sun']
+        observer = earth + Topos(latitude_degrees=latitudes, longitude_degrees=longitudes,
+                                 elevation_m=elevations)
+
+        observer_at = observer.at(t)
+        moon_astrometric = observer_at.observe(moon).apparent()
+        sun_astrometric = observer_at.observe(sun).apparent()
+        moon_alt, moon_az, moon_distance = moon_astrometric.altaz()
+        moon_alt, moon_az, moon_distance_km = moon_alt.degrees, moon_az.degrees, moon_distance.km
+        sun_alt, sun_az = (angle.degrees for angle in sun_astrometric.altaz()[:2])
+        moon_ra, moon_dec, _ = moon_astrometric.radec()
+        sun_ra, sun_dec, _ = sun_astrometric.radec()
+        moon_ra, moon_dec, sun_ra, sun_dec = moon_ra.hours, moon_dec.degrees, sun_ra.hours, sun_dec.degrees
+
+        # Topocentric Elongation Calculation
+        topocentric_elongation = moon_astrometric.separation_from(sun_astrometric).degrees
+        count('positions_total', 2 * len(latitudes), body='moon_sun', source='ephemeris')
+
+    # Moon Lag Time: from this instant (e.g. sunset) to moonset, starting from the positions above
+    if moonsets:
+        moonset_tt = _moonsets(latitudes, longitudes, elevations, t.tt, moon_alt, moon_az, moon_distance_km, series)
+    else:
+        moonset_tt = np.full(len(latitudes), np.nan)
+    moon_lag_time = (moonset_tt - t.tt) * 24
+
+    return {
+        'moon_alt': moon_alt,
+        'sun_alt': sun_alt,
+        'topocentric_elongation': topocentric_elongation,
+        'azimuth_diff': moon_az - sun_az,
+        'moon_ra': moon_ra,
+        'moon_dec': moon_dec,
+        'sun_ra': sun_ra,
+        'sun_dec': sun_dec,
+        'moon_az': moon_az,
+        'sun_az': sun_az,
+        # Lama Hilal: how long the Moon stays above the horizon from this instant
+        'lama_hilal': np.maximum(moon_lag_time, 0),
+        'moon_lag_time': moon_lag_time,
+        'moonset_tt': moonset_tt,
+        'moon_distance': moon_distance_km,
+    }
+
+
+def _geocentric_fields(t, series=None):
+    """Quantities that only depend on time."""
+    if series is not None and series.covers(t.tt):
+        # Astrometric, like the ephemeris path below and the scalar report
+        moon_vector = series.geocentric('moon', t.tt, astrometric=True)
+        sun_vector = series.geocentric('sun', t.tt, astrometric=True)
+        geocentric_elongation = separation(moon_vector, sun_vector)
+        cahaya = fraction_illuminated(moon_vector, sun_vector) * 100
+    else:
+        eph = get_ephemeris()
+        earth, moon, sun = eph['earth'], eph['moon'], eph['sun']
+        earth_at = earth.at(t)
+        geocentric_elongation = earth_at.observe(moon).separation_from(earth_at.observe(sun)).degrees
+        cahaya = almanac.fraction_illuminated(eph, 'moon', t) * 100
+    return {
+        'geocentric_elongation': geocentric_elongation,
+        'cahaya': cahaya,
+        # Divide by 12.5 to get Usbu' value
+        'cahaya_usbu': cahaya / 12.5,
+    }
+
+
+def compute_moon_sun_batch(latitudes, longitudes, times, elevations=None, series=None, moonsets=False):
+    """Computes Moon and Sun data for every observer at every time.
+
+    `latitudes`, `longitudes` (and optionally `elevations` in meters) describe
+    N observers; `times` is a Skyfield Time holding one or M instants.
+    Passing an apparent_series.ApparentSeries that covers the times takes the
+    positions from its fitted polynomials instead of the ephemeris.
+    The moonset and lag time are only solved with `moonsets=True`.
+    Returns a dict of the BATCH_FIELDS, each a NumPy array of shape (N, M).
+    """
+    latitudes = _as_array(latitudes)
+    longitudes = _as_array(longitudes)
+    elevations = _as_array(elevations, like=latitudes)
+    n = len(latitudes)
+    m = len(np.atleast_1d(times.tt))
+    shape = (n, m)
+
+    # One flattened (observer, time) pair per element
+    data = _topocentric_fields(np.repeat(latitudes, m), np.repeat(longitudes, m),
+                               np.repeat(elevations, m), _time_grid(times, n), series, moonsets)
+    data = {name: values.reshape(shape) for name, values in data.items()}
+    for name, values in _geocentric_fields(_time_grid(times, 1), series).items():
+        data[name] = np.broadcast_to(values, shape)
+    return data
+
+
+def compute_moon_sun_pairs(latitudes, longitudes, times, elevations=None, series=None, moonsets=False):
+    """Computes Moon and Sun data for observer i at time i.
+
+    Like compute_moon_sun_batch, but `times` holds one instant per observer
+    (e.g. each observer's own sunset).  Returns a dict of 1-D arrays.
+    """
+    latitudes = _as_array(latitudes)
+    longitudes = _as_array(longitudes)
+    elevations = _as_array(elevations, like=latitudes)
+    t = _time_grid(times, 1)
+
+    data = _topocentric_fields(latitudes, longitudes, elevations, t, series, moonsets)
+    data.update(_geocentric_fields(t, series))
+    return data
+
+
+def compute_altitude_curves(latitudes, longitudes, start_tt, end_tt, samples=25, elevations=None):
+    """Moon and Sun altitudes sampled between two instants for each observer, e.g. sunset to moonset.
+
+    `start_tt` and `end_tt` are TT Julian dates, one per observer (or scalars).
+    Returns (tt, moon_alt, sun_alt), arrays of shape (N, samples); rows with a
+    NaN start or end are NaN.
+    """
+    eph = get_ephemeris()
+    latitudes = _as_array(latitudes)
+    longitudes = _as_array(longitudes)
+    elevations = _as_array(elevations, like=latitudes)
+    n = len(latitudes)
+    start_tt, end_tt = (np.broadcast_to(_as_array(values), (n,)) for values in (start_tt, end_tt))
+    tt = start_tt[:, None] + (end_tt - start_tt)[:, None] * np.linspace(0, 1, samples)[None, :]
+
+    moon_alt = np.full((n, samples), np.nan)
+    sun_alt = np.full((n, samples), np.nan)
+    valid = ~np.isnan(tt[:, 0] + tt[:, -1])
+    if valid.any():
+        observer = eph['earth'] + Topos(latitude_degrees=np.repeat(latitudes[valid], samples),
+                                        longitude_degrees=np.repeat(longitudes[valid], samples),
+                                        elevation_m=np.repeat(elevations[valid], samples))
+        observer_at = observer.at(get_timescale().tt_jd(tt[valid].ravel()))
+        shape = (int(valid.sum()), samples)
+        moon_alt[valid] = observer_at.observe(eph['moon']).apparent().altaz()[0].degrees.reshape(shape)
+        sun_alt[valid] = observer_at.observe(eph['sun']).apparent().altaz()[0].degrees.reshape(shape)
+        count('positions_total', 2 * shape[0] * samples, body='moon_sun', source='ephemeris')
+    return tt, moon_alt, sun_alt
+
+
+def meets_irnu_criteria(moon_alt, geocentric_elongation):
+    """IRNU criteria: Moon altitude above 3 degrees and geocentric elongation above 6.4 degrees."""
+    return (np.asarray(moon_alt) > IRNU_MIN_MOON_ALT) & (
+        np.asarray(geocentric_elongation) > IRNU_MIN_ELONGATION)
@@ -0,0 +1,472 @@
+"""Offline benchmarks of the report, batch and map workloads.
+
+Times the single-report building blocks (compute_moon_sun_data,
+get_moon_age_and_new_moon and the new moon search, the sunset search,
+create_visualization per render profile and the full moon_sun_report path)
+and the bulk workloads (1,000 places x 12 Hijri months of month-start rows,
+and the global visibility grid for one evening).  Each scenario runs in a
+fresh process, so its peak RSS is its own; latency percentiles and
+throughput are reported per scenario and compared against a saved baseline.
+
+Accuracy checks compare the vectorized results with independent scalar ones
+(the almanac sunset and moonset searches and one Skyfield observation per
+place) and with the reference values stored in the baseline, so a speedup
+cannot silently change the astronomical outputs.
+
+Nothing goes to the network: geocoding uses the local gazetteer only, and
+the background photo is replaced by a generated image.  Run it from the
+directory holding the ephemeris and lunation table, as for app.py:
+
+    python benchmark.py --save benchmark_baseline.json
+    python benchmark.py --quick --only positions --only sunset
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BENCHMARK_BASELINE = os.environ.get('BENCHMARK_BASELINE', 'benchmark_baseline.json')
+
+# Evening of 29 Ramadan 1446 in most of the world, and the Hijri year of the month-start table
+EVENING = (2025, 3, 29)
+HIJRI_YEAR = 1446
+CITY_COUNT = 1000
+GRID_RESOLUTION = 2
+SEED = 1446
+
+# Calls per single-report scenario and runs of the bulk scenarios (full, --quick)
+CALLS = (50, 10)
+RUNS = (3, 1)
+# A scenario whose median time grows by more than this fraction counts as a regression
+REGRESSION_THRESHOLD = 0.15
+
+# Largest accepted differences from the scalar results and from the baseline
+ANGLE_TOLERANCE_ARCSEC = 3.6
+SUNSET_TOLERANCE_SECONDS = 1.0
+LAG_TOLERANCE_SECONDS = 1.0
+CAHAYA_TOLERANCE_PERCENT = 0.001
+ACCURACY_PLACES = 50
+
+
+def _write_background(path, size=(2954, 1969)):
+    """A stand-in for the background photo: a dark sky gradient with stars, about the same size."""
+    from PIL import Image
+    rng = np.random.default_rng(SEED)
+    width, height = size
+    sky = (np.linspace(10, 70, height)[:, None, None] * np.array([0.3, 0.4, 1.0])).astype(np.uint8)
+    image = np.broadcast_to(sky, (height, width, 3)).copy()
+    stars = rng.integers(0, [height, width], size=(4000, 2))
+    image[stars[:, 0], stars[:, 1]] = 255
+    Image.fromarray(image).save(path, quality=90)
+
+
+def _offline(workdir):
+    """Process initializer: local geocoder database and background image, no Nominatim, no metrics."""
+    os.environ['GEOCODE_DB'] = os.path.join(workdir, 'geocoding.sqlite')
+    os.environ['BACKGROUND_IMAGE'] = os.path.join(workdir, 'background.jpg')
+    os.environ.pop('RESULT_CACHE_DIR', None)
+    os.environ.pop('METRICS', None)
+    # The project modules read these settings when imported, so they are only imported from here on
+    import geocoding
+    geocoding.lookup_nominatim = lambda query: None
+
+
+def benchmark_places(count=CITY_COUNT):
+    """The gazetteer's cities followed by pseudo-random places up to 60 degrees of latitude, `count` in all."""
+    from geocoding import GAZETTEER_CSV
+    with open(GAZETTEER_CSV, newline='', encoding='utf-8') as f:
+        places = [(row['name'], float(row['latitude']), float(row['longitude'])) for row in csv.DictReader(f)]
+    places = places[:count]
+    rng = np.random.default_rng(SEED)
+    extra = count - len(places)
+    latitudes = np.degrees(np.arcsin(rng.uniform(-np.sin(np.radians(60)), np.sin(np.radians(60)), extra)))
+    longitudes = rng.uniform(-180, 180, extra)
+    places += [(f"{lat:.4f},{lon:.4f}", float(lat), float(lon)) for lat, lon in zip(latitudes, longitudes)]
+    return places
+
+
+def _time_calls(function, arguments, warm_up=None):
+    """Calls `function` with each tuple of `arguments` after an untimed warm-up call; returns the durations."""
+    function(*(warm_up or arguments[0]))
+    timings = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _evening_sunsets(places):
+    from rise_set import sun_events
+    latitudes = np.array([place[1] for place in places])
+    longitudes = np.array([place[2] for place in places])
+    return latitudes, longitudes, sun_events(latitudes, longitudes, *EVENING)
+
+
+def bench_positions(options):
+    from skyfield.api import Topos
+
+    from calculator import compute_moon_sun_data
+    from ephemeris_store import get_ephemeris, get_timescale
+    eph, ts = get_ephemeris(), get_timescale()
+    latitudes, longitudes, sunset_tt = _evening_sunsets(benchmark_places(options.calls))
+    arguments = [(eph['earth'] + Topos(latitude_degrees=lat, longitude_degrees=lon), ts.tt_jd(tt))
+                 for lat, lon, tt in zip(latitudes, longitudes, sunset_tt)]
+    return _time_calls(compute_moon_sun_data, arguments), 1
+
+
+def bench_new_moon(options):
+    from calculator import get_moon_age_and_new_moon
+    from ephemeris_store import get_timescale
+    ts = get_timescale()
+    tt = ts.utc(EVENING[0], 1, 1).tt + np.linspace(0, 365, options.calls)
+    return _time_calls(get_moon_age_and_new_moon, [(ts.tt_jd(t), 7) for t in tt]), 1
+
+
+def bench_new_moon_search(options):
+    from calculator import search_new_moons
+    from ephemeris_store import get_timescale
+    ts = get_timescale()
+    tt = ts.utc(EVENING[0], 1, 1).tt + np.linspace(0, 365, max(options.calls // 5, 2))
+    return _time_calls(search_new_moons, [(ts.tt_jd(t),) for t in tt]), 1
+
+
+def bench_sunset(options):
+    from rise_set import sun_events
+    arguments = [(lat, lon) + EVENING for _, lat, lon in benchmark_places(options.calls)]
+    return _time_calls(sun_events, arguments), 1
+
+
+def _bench_visualization(options, profile):
+    from visualization import create_visualization
+    arguments = [(moon_alt, -0.83, 265.0, 270.0, moon_alt + 1.5) + EVENING + (18, 0, "Yes", "sunset", profile)
+                 for moon_alt in np.linspace(-2, 12, options.calls)]
+    return _time_calls(create_visualization, arguments), 1
+
+
+def bench_visualization_fast(options):
+    return _bench_visualization(options, 'fast')
+
+
+def bench_visualization_export(options):
+    return _bench_visualization(options, 'export')
+
+
+def bench_report(options):
+    """The request handler end to end: geocoding, timezone, sunset, positions, new moon and the render pool."""
+    from app import moon_sun_report
+    from render_pool import get_pool
+    cities = [place[0] for place in benchmark_places(CITY_COUNT) if ',' not in place[0]]
+    # A different date for every pass over the cities, so each call misses the result caches
+    days = [date(*EVENING) - timedelta(days=i // len(cities)) for i in range(options.calls)]
+    arguments = [("City", cities[i % len(cities)], None, None, "sunset", day.year, day.month, day.day,
+                  0, 0, "Yes", "fast") for i, day in enumerate(days)]
+    later = date(*EVENING) + timedelta(days=1)
+    warm_up = ("City", cities[0], None, None, "sunset", later.year, later.month, later.day, 0, 0, "Yes", "fast")
+    try:
+        return _time_calls(moon_sun_report, arguments, warm_up), 1
+    finally:
+        get_pool().shutdown()
+
+
+def bench_cities_months(options):
+    """Month-start rows for CITY_COUNT places and the 12 months of HIJRI_YEAR, timed per month."""
+    from hilal_table import month_rows
+    places = benchmark_places(options.places)
+    arguments = [(places, HIJRI_YEAR, month, options.series) for month in range(1, 13)]
+    return _time_calls(month_rows, arguments, (places[:10], HIJRI_YEAR - 1, 12, options.series)), len(places)
+
+
+def bench_global_grid(options):
+    from visibility_map import compute_visibility_map, grid_cells
+    arguments = [EVENING + (options.grid_resolution, None, 1, options.series)] * options.runs
+    warm_up = EVENING + (options.grid_resolution, (-10, 10, 100, 120), 1, options.series)
+    return _time_calls(compute_visibility_map, arguments, warm_up), len(grid_cells(options.grid_resolution))
+
+
+SCENARIOS = {
+    'positions': bench_positions,
+    'new_moon': bench_new_moon,
+    'new_moon_search': bench_new_moon_search,
+    'sunset': bench_sunset,
+    'visualization_fast': bench_visualization_fast,
+    'visualization_export': bench_visualization_export,
+    'report': bench_report,
+    'cities_months': bench_cities_months,
+    'global_grid': bench_global_grid,
+}
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _run_scenario(name, options):
+    """Worker: runs one scenario and summarizes its timings."""
+    timings, items = SCENARIOS[name](options)
+    timings = np.array(timings)
+    p50, p90, p99 = np.percentile(timings, [50, 90, 99]) * 1000
+    return {
+        'calls': len(timings), 'items_per_call': items,
+        'mean_ms': timings.mean() * 1000, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99,
+        'throughput': len(timings) * items / timings.sum(),
+        'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+        'children_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def _skyfield_reference(latitude, longitude, tt):
+    """The scalar path: Moon altitude, topocentric and geocentric elongation from one Skyfield observation."""
+    from skyfield.api import Topos
+
+    from ephemeris_store import get_ephemeris, get_timescale
+    eph, ts = get_ephemeris(), get_timescale()
+    t = ts.tt_jd(tt)
+    observer = (eph['earth'] + Topos(latitude_degrees=latitude, longitude_degrees=longitude)).at(t)
+    moon = observer.observe(eph['moon']).apparent()
+    sun = observer.observe(eph['sun']).apparent()
+    earth = eph['earth'].at(t)
+    return (moon.altaz()[0].degrees, moon.separation_from(sun).degrees,
+            earth.observe(eph['moon']).separation_from(earth.observe(eph['sun'])).degrees)
+
+
+def _geocentric_reference(tt):
+    """The scalar path: geocentric elongation (degrees) and illuminated percentage of the Moon."""
+    from skyfield import almanac
+
+    from ephemeris_store import get_ephemeris, get_timescale
+    eph, ts = get_ephemeris(), get_timescale()
+    t = ts.tt_jd(tt)
+    earth = eph['earth'].at(t)
+    return (earth.observe(eph['moon']).separation_from(earth.observe(eph['sun'])).degrees,
+            almanac.fraction_illuminated(eph, 'moon', t) * 100)
+
+
+def _almanac_sunset(latitude, longitude, year, month, day):
+    """The scalar sunset search: almanac.sunrise_sunset over the local mean day."""
+    from skyfield import almanac
+    from skyfield.api import Topos
+
+    from ephemeris_store import get_ephemeris, get_timescale
+    eph, ts = get_ephemeris(), get_timescale()
+    midnight = -longitude / 15
+    t0, t1 = ts.utc(year, month, day, midnight), ts.utc(year, month, day, midnight + 24)
+    function = almanac.sunrise_sunset(eph, Topos(latitude_degrees=latitude, longitude_degrees=longitude))
+    times, is_day = almanac.find_discrete(t0, t1, function)
+    sets = times.tt[~is_day.astype(bool)]
+    return sets[0] if len(sets) else np.nan
+
+
+def _almanac_moonset(latitude, longitude, tt):
+    """The scalar moonset search: almanac.risings_and_settings with the Moon's semidiameter at `tt`.
+
+    Like batch_engine, the next moonset while the Moon is up and the last one once it has set.
+    """
+    from skyfield import almanac
+    from skyfield.api import Topos
+
+    from ephemeris_store import get_ephemeris, get_timescale
+    from rise_set import MOON_RADIUS_KM, REFRACTION_AT_HORIZON
+    eph, ts = get_ephemeris(), get_timescale()
+    topos = Topos(latitude_degrees=latitude, longitude_degrees=longitude)
+    distance = (eph['earth'] + topos).at(ts.tt_jd(tt)).observe(eph['moon']).apparent().altaz()[2]
+    function = almanac.risings_and_settings(eph, eph['moon'], topos, horizon_degrees=REFRACTION_AT_HORIZON,
+                                            radius_degrees=np.degrees(np.arcsin(MOON_RADIUS_KM / distance.km)))
+    times, is_up = almanac.find_discrete(ts.tt_jd(tt - 1), ts.tt_jd(tt + 1), function)
+    sets = times.tt[~is_up.astype(bool)]
+    if function(ts.tt_jd(tt)):
+        sets = sets[sets > tt]
+        return sets[0] if len(sets) else np.nan
+    sets = sets[sets <= tt]
+    return sets[-1] if len(sets) else np.nan
+
+
+def _difference(values, reference, scale):
+    """(values - reference) * scale, infinite where only one of the two is NaN."""
+    values, reference = np.asarray(values, dtype=float), np.asarray(reference, dtype=float)
+    return np.where(np.isnan(values) != np.isnan(reference), np.inf, (values - reference) * scale)
+
+
+def _check(name, differences, tolerance, unit):
+    error = float(np.nanmax(np.abs(differences))) if np.any(~np.isnan(differences)) else 0.0
+    return {'check': name, 'max_error': error, 'tolerance': tolerance, 'unit': unit,
+            'ok': bool(error <= tolerance)}
+
+
+def accuracy_reference(options):
+    """Worker: compares the vectorized results with the scalar ones; returns the checks and reference values."""
+    from apparent_series import load_apparent_series
+    from batch_engine import compute_moon_sun_batch, compute_moon_sun_pairs
+    from ephemeris_store import get_timescale
+    from visibility_map import compute_visibility_map
+    ts = get_timescale()
+    series = load_apparent_series(options.series) if options.series else None
+
+    places = benchmark_places(options.places)
+    places = places[::max(len(places) // ACCURACY_PLACES, 1)][:ACCURACY_PLACES]
+    latitudes, longitudes, sunset_tt = _evening_sunsets(places)
+    scalar_sunset_tt = np.array([_almanac_sunset(lat, lon, *EVENING) for lat, lon in zip(latitudes, longitudes)])
+
+    data = compute_moon_sun_pairs(latitudes, longitudes, ts.tt_jd(sunset_tt), series=series, moonsets=True)
+    scalar = np.array([_skyfield_reference(lat, lon, tt) for lat, lon, tt in zip(latitudes, longitudes, sunset_tt)])
+    scalar_moonset_tt = np.array([_almanac_moonset(lat, lon, tt)
+                                  for lat, lon, tt in zip(latitudes, longitudes, sunset_tt)])
+
+    # Geocentric values over a lunation, so elongations from 0 to 180 degrees are covered
+    lunation_tt = ts.utc(*EVENING).tt + np.arange(0, 30, 0.25)
+    lunation = compute_moon_sun_batch([0.0], [0.0], ts.tt_jd(lunation_tt), series=series)
+    lunation_scalar = np.array([_geocentric_reference(tt) for tt in lunation_tt])
+
+    grid = compute_visibility_map(*EVENING, resolution=1, workers=1, series_path=options.series)
+    grid = grid[~np.isnan(grid['sunset_tt'])][::20]
+    grid_scalar = np.array([_skyfield_reference(float(cell['lat']), float(cell['lon']), cell['sunset_tt'])
+                            for cell in grid])
+
+    checks = [
+        _check('sunset vs almanac', _difference(sunset_tt, scalar_sunset_tt, 86400), SUNSET_TOLERANCE_SECONDS, 's'),
+        _check('moon_alt vs scalar', (data['moon_alt'] - scalar[:, 0]) * 3600, ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('topocentric_elongation vs scalar', (data['topocentric_elongation'] - scalar[:, 1]) * 3600,
+               ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('geocentric_elongation vs scalar', (data['geocentric_elongation'] - scalar[:, 2]) * 3600,
+               ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('lunation geocentric_elongation vs scalar',
+               (lunation['geocentric_elongation'][0] - lunation_scalar[:, 0]) * 3600, ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('lunation cahaya vs almanac', lunation['cahaya'][0] - lunation_scalar[:, 1],
+               CAHAYA_TOLERANCE_PERCENT, '%'),
+        _check('moonset vs almanac', _difference(data['moonset_tt'], scalar_moonset_tt, 86400),
+               LAG_TOLERANCE_SECONDS, 's'),
+        # The grid stores float32, about 0.03 arcseconds
+        _check('map moon_alt vs scalar', (grid['moon_alt'] - grid_scalar[:, 0]) * 3600, ANGLE_TOLERANCE_ARCSEC,
+               'arcsec'),
+        _check('map geocentric_elongation vs scalar', (grid['geocentric_elongation'] - grid_scalar[:, 2]) * 3600,
+               ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+    ]
+    reference = {
+        'latitude': latitudes.tolist(), 'longitude': longitudes.tolist(),
+        'sunset_tt': sunset_tt.tolist(), 'moon_alt': data['moon_alt'].tolist(),
+        'geocentric_elongation': data['geocentric_elongation'].tolist(),
+        'moon_lag_time': data['moon_lag_time'].tolist(),
+    }
+    return checks, reference
+
+
+def compare_reference(reference, baseline):
+    """Checks the reference values against those saved in the baseline, for the same places."""
+    if not baseline or baseline.get('latitude') != reference['latitude'] or (
+            baseline.get('longitude') != reference['longitude']):
+        return []
+
+    def difference(name, scale):
+        return _difference(reference[name], baseline[name], scale)
+
+    return [
+        _check('sunset vs baseline', difference('sunset_tt', 86400), SUNSET_TOLERANCE_SECONDS, 's'),
+        _check('moon_alt vs baseline', difference('moon_alt', 3600), ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('geocentric_elongation vs baseline', difference('geocentric_elongation', 3600),
+               ANGLE_TOLERANCE_ARCSEC, 'arcsec'),
+        _check('moon_lag_time vs baseline', difference('moon_lag_time', 3600), LAG_TOLERANCE_SECONDS, 's'),
+    ]
+
+
+def _in_fresh_process(workdir, function, *args):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_offline,
+                             initargs=(workdir,)) as pool:
+        return pool.submit(function, *args).result()
+
+
+def format_results(results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """The scenario table and the accuracy checks as text, and whether anything regressed or failed."""
+    baseline_scenarios = (baseline or {}).get('scenarios', {})
+    lines = [f"{'scenario':<22}{'calls':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+             f"{'items/s':>11}{'peak MB':>9}  vs baseline"]
+    failed = False
+    for name, result in results['scenarios'].items():
+        change = ''
+        before = baseline_scenarios.get(name)
+        if before:
+            ratio = result['p50_ms'] / before['p50_ms'] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > threshold:
+                change += "  SLOWER"
+                failed = True
+        peak = max(result['peak_rss_mb'], result['children_peak_rss_mb'])
+        lines.append(f"{name:<22}{result['calls']:>6}{result['p50_ms']:>10.2f}{result['p90_ms']:>10.2f}"
+                     f"{result['p99_ms']:>10.2f}{result['throughput']:>11.1f}{peak:>9.0f}  {change}")
+    if results.get('accuracy'):
+        lines.append('')
+        for check in results['accuracy']:
+            failed = failed or not check['ok']
+            lines.append(f"{'ok  ' if check['ok'] else 'FAIL'} {check['check']:<38} "
+                         f"{check['max_error']:.4f} {check['unit']} (max {check['tolerance']})")
+    return '\n'.join(lines), failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the report, batch and map workloads.")
+    parser.add_argument('--only', action='append', choices=list(SCENARIOS), help="scenario to run (repeatable)")
+    parser.add_argument('--quick', action='store_true', help="fewer calls and places, for a fast check")
+    parser.add_argument('--calls', type=int, help="calls per single-report scenario")
+    parser.add_argument('--grid-resolution', type=int, default=GRID_RESOLUTION, help="H3 resolution of the grid")
+    parser.add_argument('--series', help="apparent_series.py file for the batch and map scenarios")
+    parser.add_argument('--no-accuracy', action='store_true', help="skip the accuracy checks")
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE, help="results to compare against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown of the median counted as a regression (fraction)")
+    parser.add_argument('--save', help="write the results as JSON (e.g. as the new baseline)")
+    args = parser.parse_args(argv)
+    args.calls = args.calls or CALLS[args.quick]
+    args.runs = RUNS[args.quick]
+    args.places = CITY_COUNT // 10 if args.quick else CITY_COUNT
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        # Also in a child process: children start with the parent's peak RSS, so the parent stays small
+        _in_fresh_process(workdir, _write_background, os.path.join(workdir, 'background.jpg'))
+        results = {
+            'environment': {
+                'python': platform.python_version(), 'platform': platform.platform(),
+                'cpus': os.cpu_count(), 'numpy': np.__version__, 'quick': args.quick, 'series': args.series,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            },
+            'scenarios': {},
+        }
+        for name in args.only or SCENARIOS:
+            print(f"Running {name}...", file=sys.stderr)
+            results['scenarios'][name] = _in_fresh_process(workdir, _run_scenario, name, args)
+        if not args.no_accuracy:
+            print("Checking accuracy...", file=sys.stderr)
+            checks, reference = _in_fresh_process(workdir, accuracy_reference, args)
+            results['accuracy'] = checks + compare_reference(reference, (baseline or {}).get('reference'))
+            results['reference'] = reference
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text, failed = format_results(results, baseline, args.threshold)
+    print(text)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
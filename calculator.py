@@ -0,0 +1,323 @@
+"""Moon and Sun report computations, independent of the web interface.
+
+Everything the Gradio app shows is computed here, so command line tools,
+workers and tests can import it without loading the interface.  The
+ephemeris, timescale and lunation table are opened on first use through
+their accessors rather than at import time.
+"""
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from skyfield import almanac
+from skyfield.api import Topos
+from skyfield.units import Angle
+
+from batch_engine import BATCH_FIELDS, compute_altitude_curves, compute_moon_sun_batch, meets_irnu_criteria
+from ephemeris_store import get_ephemeris, get_timescale, get_year_range
+from geocoding import geocode
+from lunations import get_lunation_table
+from metrics import count, span
+from result_cache import report_cache, report_key, report_ttl
+from rise_set import cached_sun_events
+from snapshots import current_values, record_query
+from timezones import local_utc_offset_hours, resolve_timezone, utc_offset_hours
+
+logger = logging.getLogger(__name__)
+
+# Moon altitudes shown from sunset to moonset, both included
+ALTITUDE_CURVE_SAMPLES = 5
+
+def get_moon_age_and_new_moon(time, utc_offset):
+    """Calculate Moon Age and Time of New Moon in local time."""
+    ts = get_timescale()
+    # Look the new moons up in the precomputed lunation table when it covers this time
+    lunation_table = get_lunation_table()
+    if lunation_table.covers(time.tt):
+        previous_new_moon = ts.tt_jd(lunation_table.previous_new_moon(time.tt))
+        next_new_moon = ts.tt_jd(lunation_table.next_new_moon(time.tt))
+    else:
+        count('new_moon_searches_total')
+        previous_new_moon, next_new_moon = search_new_moons(time)
+
+    # Calculate Moon Age (time since last new moon)
+    moon_age_days = (time.tt - previous_new_moon.tt)
+
+    # Convert new moon times to local time
+    previous_new_moon_local = previous_new_moon.utc_datetime() + timedelta(hours=utc_offset)
+    next_new_moon_local = next_new_moon.utc_datetime() + timedelta(hours=utc_offset)
+
+    return moon_age_days, previous_new_moon_local, next_new_moon_local
+
+def search_new_moons(time):
+    """Finds the previous and next new moons with a root search around `time`."""
+    eph, ts = get_ephemeris(), get_timescale()
+    # Find the previous and next new moons
+    t0 = ts.utc(time.utc_datetime() - timedelta(days=30))
+    t1 = ts.utc(time.utc_datetime() + timedelta(days=30))
+    phases = almanac.moon_phases(eph)
+    times, events = almanac.find_discrete(t0, t1, phases)
+
+    # Filter for new moons (event == 0) and convert to UTC datetime for comparison
+    new_moons = [(t, t.utc_datetime()) for t, e in zip(times, events) if e == 0]
+    current_time = time.utc_datetime()
+
+    # Find the most recent new moon
+    previous_new_moon = max((t for t, dt in new_moons if dt <= current_time),
+                          key=lambda t: t.utc_datetime())
+
+    # Find the next new moon
+    next_new_moon = min((t for t, dt in new_moons if dt > current_time),
+                       key=lambda t: t.utc_datetime())
+
+    return previous_new_moon, next_new_moon
+
+def compute_moon_sun_data(observer, time):
+    """Computes Moon and Sun data at the specified time."""
+    return moon_sun_tuple(compute_moon_sun_values_at(observer, time))
+
+def compute_moon_sun_values_at(observer, time):
+    """Computes the BATCH_FIELDS at the specified time as a dict, including the moonset."""
+    # Evaluate a 1 x 1 batch for the observer's geographic position
+    topos = observer.vector_functions[-1]
+    data = compute_moon_sun_batch([topos.latitude.degrees], [topos.longitude.degrees], time,
+                                  elevations=[topos.elevation.m], moonsets=True)
+    return {name: data[name][0, 0] for name in BATCH_FIELDS}
+
+def moon_sun_tuple(values):
+    """The values of compute_moon_sun_data from a dict of BATCH_FIELDS."""
+    return (values['moon_alt'], values['sun_alt'], values['topocentric_elongation'],
+            values['geocentric_elongation'], values['azimuth_diff'],
+            Angle(hours=values['moon_ra']), Angle(degrees=values['moon_dec']),
+            Angle(hours=values['sun_ra']), Angle(degrees=values['sun_dec']),
+            values['moon_az'], values['sun_az'], values['lama_hilal'], values['cahaya'],
+            values['cahaya_usbu'], values['moon_lag_time'])
+
+def check_irnu_criteria(moon_alt, geocentric_elongation):
+    if meets_irnu_criteria(moon_alt, geocentric_elongation):
+        return ("✅ MEMENUHI KRITERIA IRNU\n"
+                "✅ Meets IRNU Criteria\n"
+                "✅ 符合 IRNU 标准\n"
+                "✅ يفي بمعايير IRNU")
+    else:
+        return ("❌ TIDAK MEMENUHI KRITERIA IRNU\n"
+                "❌ Does not meet IRNU Criteria\n"
+                "❌ 不符合 IRNU 标准\n"
+                "❌ لا يفي بمعايير IRNU")
+
+def get_cardinal_direction(azimuth):
+    """Converts azimuth degrees to a cardinal direction with icons."""
+    directions = {
+        "U": "⬆️ Utara",
+        "UTL": "↗️ Utara-Timur Laut",
+        "TL": "↗️ Timur Laut",
+        "TTL": "↗️ Timur-Timur Laut",
+        "T": "➡️ Timur",
+        "TTG": "↘️ Timur-Tenggara",
+        "TG": "↘️ Tenggara",
+        "STG": "↘️ Selatan-Tenggara",
+        "S": "⬇️ Selatan",
+        "SBD": "↙️ Selatan-Barat Daya",
+        "BD": "↙️ Barat Daya",
+        "BBD": "↙️ Barat-Barat Daya",
+        "B": "⬅️ Barat",
+        "BBL": "↖️ Barat-Barat Laut",
+        "BL": "↖️ Barat Laut",
+        "UBL": "↖️ Utara-Barat Laut"
+    }
+    index = int((azimuth + 11.25) / 22.5) % 16
+    return list(directions.values())[index]
+
+class ReportError(Exception):
+    """A problem with the user's input, reported back as the report text."""
+
+def resolve_location(location_option, city, manual_lat, manual_lon):
+    """Returns the latitude and longitude of the chosen city or of the manual input."""
+    if location_option == "City":
+        with span("geocode"):
+            location = geocode(city)
+        if not location:
+            raise ReportError("Location not found. Please check your city name.")
+        return location.latitude, location.longitude
+    # Manual input
+    if manual_lat is None or manual_lon is None:
+        raise ReportError("Please provide both latitude and longitude for manual input.")
+    return manual_lat, manual_lon
+
+def check_year(year):
+    """Raises ReportError when the ephemeris does not cover `year`."""
+    first_year, last_year = get_year_range()
+    if not first_year <= int(year) <= last_year:
+        raise ReportError(f"Dates must be between the years {first_year} and {last_year}.")
+
+def compute_moon_sun_report(location_option, city, manual_lat, manual_lon,
+                            time_option, year, month, day, hour, minute, day29, render_profile="export"):
+    """Computes the report text, the arguments for create_visualization and the image cache key.
+
+    The numeric results are cached per quantized location, mode and date; on
+    error the report is the error message and the other two are None.
+    """
+    try:
+        latitude, longitude = resolve_location(location_option, city, manual_lat, manual_lon)
+        record_query(latitude, longitude)
+        key = report_key(latitude, longitude, time_option, year, month, day, hour, minute)
+        values = report_cache.get(key)
+        if values is None:
+            with span("compute"):
+                values = compute_moon_sun_values(latitude, longitude, time_option, year, month, day, hour, minute)
+            report_cache.put(key, values, ttl=report_ttl(time_option))
+
+        if location_option == "City":
+            location_label = f"Kota: {city}"
+        else:
+            location_label = f"Manual: (Lintang: {latitude:.4f}, Bujur: {longitude:.4f})"
+        report = format_report(values, location_label, time_option, day29)
+
+        # Arguments for the visualization, rendered in the render pool
+        plot_args = (values['moon_alt'], values['sun_alt'], values['moon_azimuth'], values['sun_azimuth'],
+                     values['geocentric_elongation'], year, month, day,
+                     hour, minute, day29, time_option)
+        image_key = key + (day29, render_profile)
+        return report, plot_args, image_key
+
+    except ReportError as e:
+        return str(e), None, None
+    except Exception as e:
+        # Unexpected: keep the traceback in the logs, and show the message to the user
+        count('report_errors_total', error=type(e).__name__)
+        logger.exception("Report failed (location_option=%r, city=%r, lat=%r, lon=%r, time_option=%r, "
+                         "date=%r-%r-%r %r:%r)", location_option, city, manual_lat, manual_lon,
+                         time_option, year, month, day, hour, minute)
+        return f"An error occurred: {str(e)}", None, None
+
+def compute_moon_sun_values(latitude, longitude, time_option, year, month, day, hour, minute):
+    """Computes the numeric results of the report as a dict of plain values."""
+    if time_option.lower() != "current":
+        check_year(year)
+    ts = get_timescale()
+    observer_location = Topos(latitude_degrees=latitude, longitude_degrees=longitude)
+    observer = get_ephemeris()['earth'] + observer_location
+
+    # Get timezone information, with the UTC offset in force on the requested date
+    with span("timezone"):
+        timezone_str = resolve_timezone(latitude, longitude)
+    if timezone_str:
+        if time_option.lower() == "current":
+            utc_offset = utc_offset_hours(timezone_str, datetime.utcnow())
+        elif time_option.lower() == "sunset":
+            utc_offset = local_utc_offset_hours(timezone_str, datetime(int(year), int(month), int(day), 12))
+        else:
+            utc_offset = local_utc_offset_hours(timezone_str, datetime(int(year), int(month), int(day),
+                                                                       int(hour), int(minute)))
+    else:
+        timezone_str = "Unknown"
+        utc_offset = 8  # default if not found
+    tz_info = f"{timezone_str} (UTC+{utc_offset:.0f})"
+
+    # Determine the time based on time option
+    if time_option.lower() == "sunset":
+        with span("sunset"):
+            sunset_tt = cached_sun_events(latitude, longitude, year, month, day)[0]
+        if np.isnan(sunset_tt):
+            raise ReportError("Sunset not found for the given date at this location.")
+        time_obj = ts.tt_jd(sunset_tt)  # sunset time
+        time_label = "(sunset)"
+        time_display = time_obj.utc_datetime() + timedelta(hours=utc_offset)
+    elif time_option.lower() == "specific":
+        user_time = datetime(year, month, day, hour, minute)
+        utc_time = user_time - timedelta(hours=utc_offset)
+        time_obj = ts.utc(utc_time.year, utc_time.month, utc_time.day, utc_time.hour, utc_time.minute)
+        time_label = "(Local Time)"
+        time_display = user_time
+    else:  # current
+        time_obj = ts.now()
+        time_label = "(Current Time)"
+        time_display = time_obj.utc_datetime() + timedelta(hours=utc_offset)
+
+    # Compute Moon and Sun positions
+    with span("positions"):
+        # Popular places in current mode come from the latest snapshot
+        positions = current_values(latitude, longitude, time_obj.tt) if time_option.lower() == "current" else None
+        if positions is None:
+            positions = compute_moon_sun_values_at(observer, time_obj)
+        (moon_alt, sun_alt, topocentric_elongation, geocentric_elongation,
+         azimuth_diff, moon_ra, moon_dec, sun_ra, sun_dec, moon_azimuth, sun_azimuth, lama_hilal, cahaya, cahaya_usbu,
+         moon_lag_time) = moon_sun_tuple(positions)
+        moonset_tt = positions['moonset_tt']
+
+    # Moonset in local time (the one the lag time refers to)
+    moonset_local = None if np.isnan(moonset_tt) else ts.tt_jd(moonset_tt).utc_datetime() + timedelta(hours=utc_offset)
+
+    # Moon altitude from sunset until it sets, when it sets after the Sun
+    altitude_curve = []
+    if time_option.lower() == "sunset" and moonset_tt > time_obj.tt:
+        with span("altitude_curve"):
+            curve_tt, curve_alt, _ = compute_altitude_curves([latitude], [longitude], time_obj.tt, moonset_tt,
+                                                             samples=ALTITUDE_CURVE_SAMPLES)
+        altitude_curve = [(moment + timedelta(hours=utc_offset), float(alt))
+                          for moment, alt in zip(ts.tt_jd(curve_tt[0]).utc_datetime(), curve_alt[0])]
+
+    # Calculate Moon Age and New Moon Time
+    with span("new_moon"):
+        moon_age_days, previous_new_moon_local, next_new_moon_local = get_moon_age_and_new_moon(time_obj, utc_offset)
+
+    return {
+        'time_display': time_display, 'time_label': time_label, 'tz_info': tz_info,
+        'moon_age_days': float(moon_age_days),
+        'previous_new_moon_local': previous_new_moon_local, 'next_new_moon_local': next_new_moon_local,
+        'moon_alt': float(moon_alt), 'sun_alt': float(sun_alt),
+        'topocentric_elongation': float(topocentric_elongation),
+        'geocentric_elongation': float(geocentric_elongation), 'azimuth_diff': float(azimuth_diff),
+        'moon_ra_hours': moon_ra.hours, 'moon_dec_degrees': moon_dec.degrees,
+        'sun_ra_hours': sun_ra.hours, 'sun_dec_degrees': sun_dec.degrees,
+        'moon_azimuth': float(moon_azimuth), 'sun_azimuth': float(sun_azimuth),
+        'lama_hilal': float(lama_hilal), 'cahaya': float(cahaya), 'cahaya_usbu': float(cahaya_usbu),
+        'moon_lag_time': float(moon_lag_time), 'moonset_local': moonset_local,
+        'altitude_curve': altitude_curve,
+    }
+
+def format_report(values, location_label, time_option, day29):
+    """Builds the report string from the values of compute_moon_sun_values."""
+    moon_age_hours = values['moon_age_days'] * 24
+    moon_age_days_int = int(moon_age_hours // 24)
+    moon_age_hours_rem = moon_age_hours % 24
+    cardinal_direction = get_cardinal_direction(values['moon_azimuth'])
+    moon_ra, moon_dec = Angle(hours=values['moon_ra_hours']), Angle(degrees=values['moon_dec_degrees'])
+    sun_ra, sun_dec = Angle(hours=values['sun_ra_hours']), Angle(degrees=values['sun_dec_degrees'])
+
+    # Build the report string
+    report = "----- Laporan Posisi Bulan dan Matahari -----\n"
+    report += f"Tanggal dan Waktu: {values['time_display'].strftime('%Y-%m-%d %H:%M')} {values['time_label']}\n"
+    report += f"Lokasi Pengamat: {location_label}\n"
+    report += f"Zona Waktu: {values['tz_info']}\n\n"
+    report += f"🌙 Umur Bulan: {moon_age_days_int} hari {moon_age_hours_rem:.2f} jam (sejak bulan baru terakhir)\n"
+    report += f"🌑 Bulan Baru Sebelumnya: {values['previous_new_moon_local'].strftime('%Y-%m-%d %H:%M')} Waktu Setempat\n"
+    report += f"🌑 Bulan Baru Berikutnya: {values['next_new_moon_local'].strftime('%Y-%m-%d %H:%M')} Waktu Setempat\n\n"
+    report += f"🌙 Ketinggian Bulan: {values['moon_alt']:.2f}°\n"
+    if time_option.lower() == "sunset": # Add condition to display Moon Lag Time only for sunset
+      report += f"🌙 Moon Lag Time: {values['moon_lag_time']:.2f} hours\n" # Add this line
+      if values.get('moonset_local') is not None:
+        report += f"🌙 Bulan Terbenam: {values['moonset_local'].strftime('%Y-%m-%d %H:%M')} Waktu Setempat\n"
+      if values.get('altitude_curve'):
+        curve = ", ".join(f"{moment.strftime('%H:%M')} {alt:.2f}°" for moment, alt in values['altitude_curve'])
+        report += f"🌙 Ketinggian Bulan hingga terbenam: {curve}\n"
+
+    # report += f"🌙 Lama Hilal (Visibility Duration): {values['lama_hilal']:.2f} hours\n"
+    report += f"🌙 Cahaya: {values['cahaya']:.2f}% ({values['cahaya_usbu']:.2f} Usbu')\n"
+    report += f"☀ Azimuth Matahari: {values['sun_azimuth']:.2f}°\n"
+    report += f"☀ Ketinggian Matahari: {values['sun_alt']:.2f}°\n"
+    report += f"🔭 Elongasi Topocentric Bulan-Matahari: {values['topocentric_elongation']:.2f}°\n"
+    report += f"🔭 Elongasi Geosentris Bulan-Matahari: {values['geocentric_elongation']:.2f}°\n"
+    report += f"🧭 Azimuth Bulan: {values['moon_azimuth']:.2f}° ({cardinal_direction})\n"
+    report += f"🧭 Perbedaan Azimuth Bulan dan Matahari: {values['azimuth_diff']:.2f}°\n\n"
+    report += f"Asensio Rekta Bulan: {moon_ra.hms()}\n"
+    report += f"Deklinasi Bulan: {moon_dec.dms()}\n"
+    report += f"Asensio Rekta Matahari: {sun_ra.hms()}\n"
+    report += f"Deklinasi Matahari: {sun_dec.dms()}\n\n"
+
+    if day29 == "Yes":
+        report += "----------------------------------------\n"
+        report += "Note:\n1. IRNU criteria are primarily applicable on the 29th day of the Hijri calendar.\n2. These criteria serve as a reference only.\n3. Using these criteria on days other than the 29th is not recommended.\n4. Local sighting and other factors are crucial for determining the start of a new lunar month.\n\n"
+        report += check_irnu_criteria(values['moon_alt'], values['geocentric_elongation'])
+
+    return report
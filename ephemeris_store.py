@@ -0,0 +1,131 @@
+"""Compact ephemeris store for the Moon-Sun calculator.
+
+The full DE441 kernel is about 3 GB and spans -13200 to +17191, but the
+calculator only ever needs the Sun, the Moon and the Earth (plus the
+Jupiter and Saturn barycenters Skyfield uses for light deflection) for a few
+centuries.  This module extracts just those SPK segments for a configurable
+year range into a small kernel, and opens it read-only so that every worker
+process shares one page-cache copy of the data.
+
+Build the trimmed kernel once with:
+
+    python ephemeris_store.py de441.bsp de441_trimmed.bsp --start 1970 --end 2200
+"""
+import argparse
+import os
+from functools import lru_cache
+
+from jplephem.calendar import compute_calendar_date, compute_julian_date
+from jplephem.daf import DAF
+from jplephem.excerpter import write_excerpt
+from jplephem.spk import SPK
+from skyfield.api import Loader, load_file
+
+FULL_EPHEMERIS = 'de441.bsp'
+# Directory where Skyfield keeps downloaded files (only the full kernel, if ever)
+SKYFIELD_DATA_DIR = os.environ.get('SKYFIELD_DATA_DIR', '.')
+TRIMMED_EPHEMERIS = os.environ.get('EPHEMERIS_PATH', 'de441_trimmed.bsp')
+# DE441 stores each body in two segments split in July 1969, and Skyfield
+# uses a single segment per body, so the default range starts after the split.
+DEFAULT_START_YEAR = 1970
+DEFAULT_END_YEAR = 2200
+
+# NAIF ids of the segments needed for earth, moon and sun:
+#   0 -> 3   Solar System Barycenter -> Earth-Moon Barycenter
+#   3 -> 301 Earth-Moon Barycenter -> Moon
+#   3 -> 399 Earth-Moon Barycenter -> Earth
+#   0 -> 10  Solar System Barycenter -> Sun
+#   0 -> 5   Solar System Barycenter -> Jupiter Barycenter (apparent() deflection)
+#   0 -> 6   Solar System Barycenter -> Saturn Barycenter (apparent() deflection)
+SEGMENT_TARGETS = (3, 301, 399, 10, 5, 6)
+
+# Extra days kept on both sides of the range so that the +/-30 day new moon
+# search and light-time corrections never run off the end of the kernel.
+MARGIN_DAYS = 60
+
+
+def trim_ephemeris(source_path, output_path, start_year=DEFAULT_START_YEAR,
+                   end_year=DEFAULT_END_YEAR, targets=SEGMENT_TARGETS):
+    """Writes an excerpt of `source_path` holding only `targets` for the given years."""
+    start_jd = compute_julian_date(start_year, 1, 1) - MARGIN_DAYS
+    end_jd = compute_julian_date(end_year + 1, 1, 1) + MARGIN_DAYS
+
+    with open(source_path, 'rb') as f:
+        spk = SPK(DAF(f))
+        # Keep, for each target, the one segment that covers the whole range
+        summaries = {}
+        for summary, segment in zip(spk.daf.summaries(), spk.segments):
+            if segment.target in targets and segment.start_jd <= start_jd and segment.end_jd >= end_jd:
+                summaries.setdefault(segment.target, summary)
+
+        missing = set(targets) - set(summaries)
+        if missing:
+            raise ValueError(f"{source_path} has no single segment covering {start_year}-{end_year} "
+                             f"for targets {sorted(missing)}")
+
+        with open(output_path, 'w+b') as output_file:
+            write_excerpt(spk, output_file, start_jd, end_jd, list(summaries.values()))
+
+    return output_path
+
+
+@lru_cache(maxsize=None)
+def get_ephemeris(path=None):
+    """Returns the shared ephemeris, preferring the trimmed kernel when present.
+
+    Skyfield (through jplephem) maps the segment data with a read-only mmap,
+    so the pages are loaded lazily and shared between processes.
+    """
+    path = path or TRIMMED_EPHEMERIS
+    if os.path.exists(path):
+        return load_file(path)
+    # Fall back to the full kernel, downloading it if necessary
+    return Loader(SKYFIELD_DATA_DIR, verbose=False)(FULL_EPHEMERIS)
+
+
+def ephemeris_year_range(eph, start_year=DEFAULT_START_YEAR, end_year=DEFAULT_END_YEAR):
+    """Returns the whole years within `start_year`..`end_year` that `eph` can compute."""
+    # Skyfield keeps only the last segment for each target, so do the same here
+    segments = {segment.target: segment.spk_segment for segment in eph.segments}
+    used = [segments[target] for target in SEGMENT_TARGETS if target in segments]
+    # Round to the minute so exact year boundaries survive the seconds-to-JD conversion
+    first_jd = round((max(segment.start_jd for segment in used) + MARGIN_DAYS) * 1440) / 1440
+    last_jd = round((min(segment.end_jd for segment in used) - MARGIN_DAYS) * 1440) / 1440
+    year, month, day = compute_calendar_date(int(first_jd + 0.5))
+    first_year = year if (month, day) == (1, 1) else year + 1
+    last_year = compute_calendar_date(int(last_jd + 0.5))[0] - 1
+    return max(start_year, first_year), min(end_year, last_year)
+
+
+@lru_cache(maxsize=None)
+def get_year_range():
+    """Returns the whole years the shared ephemeris can compute, whichever kernel it is."""
+    return ephemeris_year_range(get_ephemeris(), -13200, 17191)
+
+
+@lru_cache(maxsize=None)
+def get_timescale():
+    """Returns the shared timescale.
+
+    It uses the Delta T and leap second tables bundled with Skyfield, so
+    startup never checks for or downloads newer ones.
+    """
+    return Loader(SKYFIELD_DATA_DIR, verbose=False).timescale(builtin=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract the Earth, Moon and Sun segments of an SPK kernel for a range of years.")
+    parser.add_argument('source', nargs='?', default=FULL_EPHEMERIS, help="full SPK kernel, e.g. de441.bsp")
+    parser.add_argument('output', nargs='?', default=TRIMMED_EPHEMERIS, help="path of the trimmed kernel")
+    parser.add_argument('--start', type=int, default=DEFAULT_START_YEAR, help="first year to keep")
+    parser.add_argument('--end', type=int, default=DEFAULT_END_YEAR, help="last year to keep")
+    args = parser.parse_args(argv)
+
+    trim_ephemeris(args.source, args.output, args.start, args.end)
+    with open(args.output, 'rb') as f:
+        print(SPK(DAF(f)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Offline geocoding: a local gazetteer with a persistent cache of Nominatim results.
+
+City names are looked up, in order, in an in-process LRU cache, the local
+gazetteer (a CSV of cities indexed into SQLite by normalized name, with
+exact and prefix matching), and the persistent cache of earlier Nominatim
+answers.  Only names found in none of them go to Nominatim, and the answer
+is written back to the cache.
+
+Queries may name the country after a comma, e.g. "Medina, SA".
+"""
+import csv
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+from metrics import count
+
+logger = logging.getLogger(__name__)
+
+GAZETTEER_CSV = os.environ.get('GAZETTEER_CSV', os.path.join(os.path.dirname(__file__), 'data', 'cities.csv'))
+GEOCODE_DB = os.environ.get('GEOCODE_DB', 'geocoding.sqlite')
+# Maximum number of Nominatim answers kept on disk, least recently used evicted first
+GEOCODE_CACHE_SIZE = 10000
+# Shortest query that may match the beginning of a city name
+MIN_PREFIX_LENGTH = 3
+# Number of recent answers kept in memory
+RECENT_SIZE = 1024
+NOMINATIM_USER_AGENT = "Ephemiris Moon-Sun Calculator"
+NOMINATIM_TIMEOUT = 10
+
+Place = namedtuple('Place', 'name country latitude longitude')
+
+_lock = threading.Lock()
+_connection = None
+_geolocator = None
+_recent = OrderedDict()
+
+
+def normalize(name):
+    """Case-folds, strips accents and punctuation, and collapses whitespace."""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r'[^\w\s]', ' ', name.casefold())
+    return ' '.join(name.split())
+
+
+def build_gazetteer(connection, csv_path=GAZETTEER_CSV):
+    """(Re)loads the gazetteer table from `csv_path`, one row per name and alternate name."""
+    rows = []
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for record in csv.DictReader(f):
+            names = [record['name']] + [n for n in record.get('alternate_names', '').split('|') if n]
+            for name in names:
+                rows.append((normalize(name), record['name'], record.get('country', ''),
+                             float(record['latitude']), float(record['longitude']),
+                             int(record.get('population') or 0)))
+
+    with connection:
+        connection.execute("DELETE FROM places")
+        connection.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('gazetteer', ?)",
+                           (f"{csv_path}:{os.path.getmtime(csv_path)}",))
+
+
+def _get_connection():
+    """Opens the database on first use and refreshes the gazetteer if the CSV changed."""
+    global _connection
+    if _connection is None:
+        connection = sqlite3.connect(GEOCODE_DB, check_same_thread=False)
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS places (
+                normalized TEXT, name TEXT, country TEXT,
+                latitude REAL, longitude REAL, population INTEGER);
+            CREATE INDEX IF NOT EXISTS places_normalized ON places (normalized);
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                query TEXT PRIMARY KEY, name TEXT, country TEXT,
+                latitude REAL, longitude REAL, last_used REAL);
+        """)
+        if os.path.exists(GAZETTEER_CSV):
+            stamp = connection.execute("SELECT value FROM meta WHERE key = 'gazetteer'").fetchone()
+            if stamp is None or stamp[0] != f"{GAZETTEER_CSV}:{os.path.getmtime(GAZETTEER_CSV)}":
+                build_gazetteer(connection)
+        _connection = connection
+    return _connection
+
+
+def _split_query(query):
+    city, _, country = query.partition(',')
+    return normalize(city), country.strip().upper()
+
+
+def lookup_gazetteer(query):
+    """Finds `query` in the local gazetteer by exact, then prefix match; largest city wins."""
+    city, country = _split_query(query)
+    if not city:
+        return None
+    sql = ("SELECT name, country, latitude, longitude FROM places WHERE {} "
+           + ("AND country = ? " if country else "")
+           + "ORDER BY population DESC LIMIT 1")
+    extra = (country,) if country else ()
+    with _lock:
+        connection = _get_connection()
+        row = connection.execute(sql.format("normalized = ?"), (city,) + extra).fetchone()
+        if row is None and len(city) >= MIN_PREFIX_LENGTH:
+            # Prefix match as a range scan on the index
+            row = connection.execute(sql.format("normalized >= ? AND normalized < ?"),
+                                     (city, city + '\uffff') + extra).fetchone()
+    return Place(*row) if row else None
+
+
+def lookup_cache(query):
+    """Returns a cached Nominatim answer for `query`, marking it as recently used."""
+    key = normalize(query)
+    with _lock:
+        connection = _get_connection()
+        row = connection.execute(
+            "SELECT name, country, latitude, longitude FROM geocode_cache WHERE query = ?", (key,)).fetchone()
+        if row:
+            with connection:
+                connection.execute("UPDATE geocode_cache SET last_used = ? WHERE query = ?", (time.time(), key))
+    return Place(*row) if row else None
+
+
+def store_cache(query, place):
+    """Saves a Nominatim answer and evicts the least recently used entries beyond GEOCODE_CACHE_SIZE."""
+    with _lock:
+        connection = _get_connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?, ?)",
+                               (normalize(query),) + tuple(place) + (time.time(),))
+            connection.execute(
+                "DELETE FROM geocode_cache WHERE query NOT IN "
+                "(SELECT query FROM geocode_cache ORDER BY last_used DESC LIMIT ?)", (GEOCODE_CACHE_SIZE,))
+
+
+def lookup_nominatim(query):
+    """Asks Nominatim; returns None when the name is unknown or the service is unreachable."""
+    global _geolocator
+    from geopy.exc import GeopyError
+    from geopy.geocoders import Nominatim
+
+    if _geolocator is None:
+        _geolocator = Nominatim(user_agent=NOMINATIM_USER_AGENT, timeout=NOMINATIM_TIMEOUT)
+    try:
+        location = _geolocator.geocode(query)
+    except GeopyError as e:
+        logger.warning("Geocoding error for %r: %s", query, e)
+        return None
+    if not location:
+        return None
+    return Place(location.address, '', location.latitude, location.longitude)
+
+
+def geocode(query):
+    """Returns the Place for a city name, or None if it cannot be found."""
+    key = normalize(query)
+    with _lock:
+        if key in _recent:
+            _recent.move_to_end(key)
+            count('geocode_lookups_total', source='recent')
+            return _recent[key]
+
+    place = lookup_gazetteer(query)
+    source = 'gazetteer'
+    if place is None:
+        place = lookup_cache(query)
+        source = 'cache'
+    if place is None:
+        place = lookup_nominatim(query)
+        if place is None:
+            count('geocode_lookups_total', source='miss')
+            return None  # Not remembered, so a later retry can still succeed
+        store_cache(query, place)
+        source = 'nominatim'
+    count('geocode_lookups_total', source=source)
+
+    with _lock:
+        _recent[key] = place
+        if len(_recent) > RECENT_SIZE:
+            _recent.popitem(last=False)
+    return place
@@ -0,0 +1,259 @@
+"""Headless Hijri month-start tables.
+
+For every place and every Hijri month in a range, computes the sunset report
+of the 29th day of the preceding month, the evening on which the new month's
+crescent is sought: sunset time, Moon altitude, geocentric elongation, Moon
+age, lag time (moonset minus sunset) and the IRNU verdict.  The 29th day is taken as the local date
+of the conjunction found nearest to the start of the month in the tabular
+(arithmetic) Hijri calendar.  Rows are streamed to CSV or JSON Lines as they
+finish, and months are spread over a process pool.
+
+    python hilal_table.py 1446-9 1447-12 --city Jakarta --city Taipei --coords=-7.8,110.4 -o table.csv
+"""
+import argparse
+import csv
+import json
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import numpy as np
+
+from apparent_series import load_apparent_series
+from batch_engine import compute_moon_sun_pairs, meets_irnu_criteria
+from ephemeris_store import get_timescale
+from geocoding import geocode
+from lunations import get_lunation_table
+from rise_set import sun_events
+from timezones import resolve_timezone, utc_offset_hours
+
+# Julian date of 1 Muharram 1 AH (civil epoch) in the tabular Islamic calendar
+ISLAMIC_EPOCH = 1948439.5
+
+TABLE_FIELDS = (
+    'place', 'latitude', 'longitude', 'hijri_year', 'hijri_month', 'observation_date',
+    'conjunction_utc', 'sunset_local', 'utc_offset', 'moon_alt', 'geocentric_elongation',
+    'moon_age_hours', 'moon_lag_time', 'moonset_local', 'irnu',
+)
+
+
+def hijri_month_start_jd(year, month):
+    """Julian date of the first day of a Hijri month in the tabular calendar."""
+    return (math.ceil(29.5 * (month - 1)) + (year - 1) * 354
+            + (3 + 11 * year) // 30 + ISLAMIC_EPOCH)
+
+
+def hijri_months(start, end):
+    """Yields (year, month) from `start` through `end`, both (year, month) tuples."""
+    # Months counted from year 0, so the range is finite whatever the input
+    first, last = start[0] * 12 + start[1] - 1, end[0] * 12 + end[1] - 1
+    for index in range(first, last + 1):
+        year, month = divmod(index, 12)
+        yield year, month + 1
+
+
+def hijri_year_range():
+    """Returns the first and last Hijri years whose every month the lunation table covers."""
+    table = get_lunation_table()
+    first = int((table.new_moons[0] - ISLAMIC_EPOCH) * 30 // 10631) + 1
+    last = int((table.new_moons[-1] - ISLAMIC_EPOCH) * 30 // 10631) + 1
+    while not table.covers(hijri_month_start_jd(first, 1) - 1.5):
+        first += 1
+    while not table.covers(hijri_month_start_jd(last, 12) - 1.5):
+        last -= 1
+    return first, last
+
+
+def check_month_covered(hijri_year, hijri_month):
+    """Raises ValueError unless the lunation table has the conjunction ending the month before."""
+    if not 1 <= hijri_month <= 12:
+        raise ValueError(f"Hijri month {hijri_year}-{hijri_month} does not exist; months run from 1 to 12.")
+    if not get_lunation_table().covers(hijri_month_start_jd(hijri_year, hijri_month) - 1.5):
+        first, last = hijri_year_range()
+        raise ValueError(f"Hijri month {hijri_year}-{hijri_month} is outside the lunation table, "
+                         f"which covers the years {first} to {last} AH.")
+
+
+def month_rows(places, hijri_year, hijri_month, series_path=None):
+    """Computes the 29th-day sunset rows of one Hijri month for every place.
+
+    `places` is a list of (label, latitude, longitude).  With `series_path`,
+    positions come from that apparent_series file where it covers the dates.
+    """
+    ts = get_timescale()
+    table = get_lunation_table()
+    series = load_apparent_series(series_path) if series_path else None
+
+    # Conjunction ending the previous month
+    check_month_covered(hijri_year, hijri_month)
+    start_tt = hijri_month_start_jd(hijri_year, hijri_month)
+    i = np.argmin(np.abs(table.new_moons - (start_tt - 1.5)))
+    conjunction = ts.tt_jd(table.new_moons[i])
+    conjunction_utc = conjunction.utc_datetime()
+
+    # Local date of the conjunction at each place
+    offsets, dates = [], []
+    for _, latitude, longitude in places:
+        zone = resolve_timezone(latitude, longitude)
+        offset = utc_offset_hours(zone, conjunction_utc) if zone else round(longitude / 15)
+        offsets.append(offset)
+        dates.append((conjunction_utc + timedelta(hours=offset)).date())
+
+    # Sunsets of every place on its own date, then positions at those sunsets, in one pass each
+    latitudes = np.array([place[1] for place in places], dtype=float)
+    longitudes = np.array([place[2] for place in places], dtype=float)
+    sunset_tt = sun_events(latitudes, longitudes, [d.year for d in dates], [d.month for d in dates],
+                           [d.day for d in dates], series=series)
+    sets = ~np.isnan(sunset_tt)
+    data = {}
+    if sets.any():
+        t = ts.tt_jd(sunset_tt[sets])
+        data = compute_moon_sun_pairs(latitudes[sets], longitudes[sets], t, series=series, moonsets=True)
+        data['utc'] = t.utc_datetime()
+
+    rows = []
+    j = 0
+    for k, (label, latitude, longitude) in enumerate(places):
+        row = {
+            'place': label, 'latitude': latitude, 'longitude': longitude,
+            'hijri_year': hijri_year, 'hijri_month': hijri_month,
+            'observation_date': dates[k].isoformat(),
+            'conjunction_utc': conjunction_utc.strftime('%Y-%m-%d %H:%M'),
+            'utc_offset': offsets[k],
+        }
+        if sets[k]:
+            sunset_local = data['utc'][j] + timedelta(hours=offsets[k])
+            moonset_tt = data['moonset_tt'][j]
+            row.update({
+                'sunset_local': sunset_local.strftime('%Y-%m-%d %H:%M'),
+                'moon_alt': round(float(data['moon_alt'][j]), 4),
+                'geocentric_elongation': round(float(data['geocentric_elongation'][j]), 4),
+                'moon_age_hours': round(float(sunset_tt[k] - conjunction.tt) * 24, 4),
+                'moon_lag_time': None if np.isnan(moonset_tt) else round(float(data['moon_lag_time'][j]), 4),
+                'moonset_local': None if np.isnan(moonset_tt) else (
+                    ts.tt_jd(moonset_tt).utc_datetime() + timedelta(hours=offsets[k])).strftime('%Y-%m-%d %H:%M'),
+                'irnu': bool(meets_irnu_criteria(data['moon_alt'][j], data['geocentric_elongation'][j])),
+            })
+            j += 1
+        else:
+            row.update({'sunset_local': None, 'moon_alt': None, 'geocentric_elongation': None,
+                        'moon_age_hours': None, 'moon_lag_time': None, 'moonset_local': None, 'irnu': None})
+        rows.append(row)
+    return rows
+
+
+def _month_rows(args):
+    return month_rows(*args)
+
+
+def generate_month_table(places, start, end, workers=None, series_path=None):
+    """Yields rows for every place and every Hijri month from `start` to `end`, as they finish.
+
+    `places` is a list of (label, latitude, longitude); `start` and `end` are
+    (year, month) tuples.  Rows of different months may arrive out of order.
+    """
+    # Build the lunation table once here, not in every worker, and fail before any work if it is too short
+    for year, month in (start, end):
+        check_month_covered(year, month)
+    jobs = [(places, year, month, series_path) for year, month in hijri_months(start, end)]
+    if workers == 1:
+        for job in jobs:
+            yield from _month_rows(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(_month_rows, job) for job in jobs]):
+            yield from future.result()
+
+
+def resolve_places(cities=(), coords=()):
+    """Turns city names (geocoded) and "lat,lon[,label]" strings into (label, latitude, longitude)."""
+    places = []
+    for city in cities:
+        location = geocode(city)
+        if not location:
+            raise ValueError(f"Location not found: {city}")
+        places.append((city, location.latitude, location.longitude))
+    for coord in coords:
+        parts = coord.split(',')
+        latitude, longitude = float(parts[0]), float(parts[1])
+        label = parts[2].strip() if len(parts) > 2 else f"{latitude:.4f},{longitude:.4f}"
+        places.append((label, latitude, longitude))
+    return places
+
+
+def read_places_file(path):
+    """Reads one city name or LAT,LON[,LABEL] per line (# starts a comment); returns (cities, coords)."""
+    cities, coords = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                float(line.split(',')[0])
+                coords.append(line)
+            except ValueError:
+                cities.append(line)
+    return cities, coords
+
+
+def _parse_month(text):
+    year, _, month = text.partition('-')
+    try:
+        year, month = int(year), int(month or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a Hijri month: {text!r} (write YEAR-MONTH, e.g. 1446-9)") from None
+    if not 1 <= month <= 12:
+        raise argparse.ArgumentTypeError(f"month {month} of {text!r} is not between 1 and 12")
+    return year, month
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hijri month-start table (29th-day sunset reports).")
+    parser.add_argument('start', type=_parse_month, help="first Hijri month, e.g. 1446-9")
+    parser.add_argument('end', type=_parse_month, help="last Hijri month, e.g. 1447-12")
+    parser.add_argument('--city', action='append', default=[], help="city name (repeatable)")
+    parser.add_argument('--coords', action='append', default=[],
+                        help="LAT,LON[,LABEL] (repeatable; write --coords=-7.8,110.4 for negative latitudes)")
+    parser.add_argument('--places-file', help="file with one city name or LAT,LON[,LABEL] per line")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--series', help="apparent_series.py file to take positions from (faster)")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="output format (default from extension)")
+    parser.add_argument('-o', '--output', help="output file (default stdout)")
+    args = parser.parse_args(argv)
+
+    cities, coords = list(args.city), list(args.coords)
+    if args.places_file:
+        file_cities, file_coords = read_places_file(args.places_file)
+        cities += file_cities
+        coords += file_coords
+    try:
+        places = resolve_places(cities, coords)
+        if places:
+            check_month_covered(*args.start)
+            check_month_covered(*args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    if not places:
+        parser.error("give at least one --city, --coords or --places-file")
+
+    output_format = args.format or ('jsonl' if args.output and args.output.endswith('.jsonl') else 'csv')
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=TABLE_FIELDS) if output_format == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for row in generate_month_table(places, args.start, args.end, args.workers, args.series):
+            if writer:
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row, ensure_ascii=False) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
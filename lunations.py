@@ -0,0 +1,141 @@
+"""Precomputed lunation index.
+
+The instants of the Moon's phases never change, so instead of running a root
+search around every requested time we find all of them once for the years the
+ephemeris supports, store them as a compact binary array and answer queries
+with a binary search.
+
+Build the table ahead of time with:
+
+    python lunations.py --start 1970 --end 2200
+"""
+import argparse
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from skyfield import almanac
+
+from ephemeris_store import (DEFAULT_END_YEAR, DEFAULT_START_YEAR, ephemeris_year_range,
+                             get_ephemeris, get_timescale)
+
+LUNATION_TABLE = os.environ.get('LUNATION_TABLE_PATH', 'lunations.npy')
+
+# One row per phase event: Terrestrial Time as a Julian date, and the phase
+# index into almanac.MOON_PHASES (0 = New Moon ... 3 = Last Quarter).
+LUNATION_DTYPE = np.dtype([('tt', '<f8'), ('phase', 'i1')])
+
+NEW_MOON, FIRST_QUARTER, FULL_MOON, LAST_QUARTER = range(4)
+
+Lunation = namedtuple('Lunation', 'new_moon first_quarter full_moon last_quarter next_new_moon')
+
+
+class LunationTable:
+    """Sorted phase instants with binary-search lookups (all times are TT Julian dates)."""
+
+    def __init__(self, events):
+        self.events = events
+        self.tt = events['tt']
+        self.new_moons = np.ascontiguousarray(self.tt[events['phase'] == NEW_MOON])
+
+    def covers(self, tt):
+        """True when there is a new moon in the table on both sides of `tt`."""
+        return len(self.new_moons) > 1 and self.new_moons[0] <= tt < self.new_moons[-1]
+
+    def previous_new_moon(self, tt):
+        """Returns the last new moon at or before `tt`."""
+        i = np.searchsorted(self.new_moons, tt, side='right') - 1
+        if i < 0:
+            raise ValueError("Time is before the start of the lunation table.")
+        return self.new_moons[i]
+
+    def next_new_moon(self, tt):
+        """Returns the first new moon after `tt`."""
+        i = np.searchsorted(self.new_moons, tt, side='right')
+        if i >= len(self.new_moons):
+            raise ValueError("Time is after the end of the lunation table.")
+        return self.new_moons[i]
+
+    def moon_age(self, tt):
+        """Returns the days elapsed since the last new moon."""
+        return tt - self.previous_new_moon(tt)
+
+    def lunations(self, tt0, tt1):
+        """Yields every complete lunation whose new moon falls in [tt0, tt1)."""
+        start = np.searchsorted(self.tt, tt0, side='left')
+        stop = np.searchsorted(self.tt, tt1, side='left')
+        phases = self.events['phase']
+        for i in range(start, stop):
+            if phases[i] != NEW_MOON or i + 4 >= len(self.tt):
+                continue
+            if tuple(phases[i:i + 5]) != (NEW_MOON, FIRST_QUARTER, FULL_MOON, LAST_QUARTER, NEW_MOON):
+                continue
+            yield Lunation(*(float(x) for x in self.tt[i:i + 5]))
+
+
+def build_lunation_table(eph, ts, start_year, end_year):
+    """Finds every moon phase between the start of `start_year` and the end of `end_year`."""
+    t0 = ts.utc(start_year, 1, 1)
+    t1 = ts.utc(end_year + 1, 1, 1)
+    times, phases = almanac.find_discrete(t0, t1, almanac.moon_phases(eph))
+
+    events = np.empty(len(times), dtype=LUNATION_DTYPE)
+    events['tt'] = times.tt
+    events['phase'] = phases
+    return events
+
+
+def save_lunation_table(events, path=LUNATION_TABLE):
+    """Writes the table to a temporary file first, so that no process ever maps a partly written one."""
+    partial = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(partial, 'wb') as f:
+            np.save(f, events)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def load_lunation_table(path=LUNATION_TABLE):
+    """Memory-maps a saved table, or returns None if there is none."""
+    if not os.path.exists(path):
+        return None
+    return LunationTable(np.load(path, mmap_mode='r'))
+
+
+@lru_cache(maxsize=None)
+def get_lunation_table(path=LUNATION_TABLE):
+    """Returns the shared lunation table, building and saving it on first use.
+
+    app.py calls this during startup, so requests never wait for the build.
+    """
+    table = load_lunation_table(path)
+    if table is None:
+        eph = get_ephemeris()
+        start_year, end_year = ephemeris_year_range(eph)
+        events = build_lunation_table(eph, get_timescale(), start_year, end_year)
+        save_lunation_table(events, path)
+        table = LunationTable(events)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute the table of moon phases.")
+    parser.add_argument('output', nargs='?', default=LUNATION_TABLE, help="path of the .npy table")
+    parser.add_argument('--start', type=int, default=DEFAULT_START_YEAR, help="first year")
+    parser.add_argument('--end', type=int, default=DEFAULT_END_YEAR, help="last year")
+    args = parser.parse_args(argv)
+
+    eph = get_ephemeris()
+    first_year, last_year = ephemeris_year_range(eph)
+    start_year, end_year = max(args.start, first_year), min(args.end, last_year)
+    events = build_lunation_table(eph, get_timescale(), start_year, end_year)
+    save_lunation_table(events, args.output)
+    print(f"{args.output}: {len(events)} phases from {start_year} through {end_year}")
+
+
+if __name__ == '__main__':
+    main()
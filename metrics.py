@@ -0,0 +1,223 @@
+"""Startup timing and runtime metrics.
+
+Records how long each phase of the server's startup takes (imports, opening
+the ephemeris, building the interface, ...), so that cold-start regressions
+on new replicas show up in the logs.
+
+At runtime, `span` times the stages of a request (geocoding, timezone
+lookup, sunset search, positions, new moon search, image download and
+encoding) into histograms, and `count` increments counters such as cache
+hits and ephemeris evaluations.  Both are no-ops unless metrics are
+enabled (METRICS=1 or enable_metrics()).  The values are served in the
+Prometheus text format by start_metrics_server(), and with METRICS_LOG=1
+every span is also logged as a JSON line.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Reference point for the startup report: when this module was first imported
+_started = time.perf_counter()
+_startup_phases = []
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+METRIC_PREFIX = 'hilal_'
+# Upper bounds of the stage duration histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Span log lines go to stderr as they are, whatever the application's logging setup
+logger = logging.getLogger('metrics')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+_enabled = os.environ.get('METRICS', '') not in ('', '0')
+_log_spans = os.environ.get('METRICS_LOG', '') not in ('', '0')
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_collectors = []
+_disabled_span = nullcontext()
+
+
+@contextmanager
+def startup_phase(name):
+    """Times the enclosed block as one named startup phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_phases.append((name, time.perf_counter() - start))
+
+
+def startup_report():
+    """Returns the phases recorded so far and the total time since startup, in seconds."""
+    return {'phases': dict(_startup_phases), 'total': time.perf_counter() - _started}
+
+
+def format_startup_report():
+    """One log line summarizing the startup, followed by the same data as JSON."""
+    report = startup_report()
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in report['phases'].items())
+    data = {'total': round(report['total'], 4),
+            'phases': {name: round(seconds, 4) for name, seconds in report['phases'].items()}}
+    return f"Startup took {report['total']:.2f}s ({phases})\nstartup {json.dumps(data)}"
+
+
+def enable_metrics(enabled=True, log_spans=None):
+    """Switches runtime metrics (and optionally the JSON span log) on or off."""
+    global _enabled, _log_spans
+    _enabled = enabled
+    if log_spans is not None:
+        _log_spans = log_spans
+
+
+def metrics_enabled():
+    return _enabled
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        observe('stage_seconds', seconds, stage=self.name)
+        if _log_spans:
+            logger.info(json.dumps({'span': self.name, 'seconds': round(seconds, 6),
+                                    'error': exc_type.__name__ if exc_type else None}))
+        return False
+
+
+def span(name):
+    """Context manager timing one stage of a request (free when metrics are off)."""
+    if not _enabled:
+        return _disabled_span
+    return _Span(name)
+
+
+def count(name, value=1, **labels):
+    """Adds `value` to a counter."""
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Records one observation (seconds) in a histogram."""
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def register_collector(collector):
+    """Adds a function returning (name, labels dict, value) samples read at scrape time, e.g. cache stats."""
+    _collectors.append(collector)
+
+
+def take_snapshot():
+    """Returns and clears the values recorded in this process (used to ship them from workers)."""
+    global _counters, _histograms
+    with _lock:
+        snapshot = (_counters, _histograms)
+        _counters, _histograms = {}, {}
+    return snapshot
+
+
+def merge_snapshot(snapshot):
+    """Adds values recorded by another process."""
+    counters, histograms = snapshot
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, values in histograms.items():
+            histogram = _histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                histogram[i] += value
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def prometheus_text():
+    """Renders every counter, histogram and collected value in the Prometheus text format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+    # Samples grouped by metric, so that each family is written once under its TYPE line,
+    # even when several collectors (e.g. one per cache) report the same metric
+    families = {}
+
+    def samples(metric, kind):
+        return families.setdefault(metric, (kind, []))[1]
+
+    for (name, labels), value in counters:
+        metric = METRIC_PREFIX + name
+        samples(metric, 'counter').append(f"{metric}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in histograms:
+        metric = METRIC_PREFIX + name
+        lines = samples(metric, 'histogram')
+        for bound, bucket in zip(BUCKETS, histogram):
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {bucket}")
+        lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {histogram[-2]}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {histogram[-1]}")
+    for collector in _collectors:
+        for name, labels, value in collector():
+            metric = METRIC_PREFIX + name
+            samples(metric, 'counter' if name.endswith('_total') else 'gauge').append(
+                f"{metric}{_format_labels(sorted(labels.items()))} {value}")
+
+    lines = []
+    for metric, (kind, family) in families.items():
+        lines.append(f"# TYPE {metric} {kind}")
+        lines += family
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    """Serves /metrics on `port` from a background thread and returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
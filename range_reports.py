@@ -0,0 +1,190 @@
+"""Reports over ranges of dates, computed piece by piece so they can be streamed.
+
+Three kinds of range are covered: the sunset of every day between two dates
+at one place, the month-start rows of the months of a Hijri year at one
+place (as in hilal_table), and the global visibility map over a run of
+evenings, refined from a coarse grid to finer ones.  The generators yield
+each result as soon as it is finished, so callers can show partial results
+and stop the work by closing the generator.
+
+Every finished row (and map grid) is kept in result_cache.row_cache, keyed
+by the place's H3 cell and the date, so narrowing or extending a range only
+computes the dates not seen before; cached results are yielded first.
+"""
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from batch_engine import compute_moon_sun_pairs, meets_irnu_criteria
+from calculator import ReportError, check_year
+from ephemeris_store import get_timescale
+from hilal_table import ISLAMIC_EPOCH, hijri_year_range, month_rows
+from lunations import get_lunation_table
+from result_cache import location_key, row_cache
+from rise_set import sun_events
+from timezones import local_utc_offset_hours, resolve_timezone
+from visibility_map import MET, NO_SUNSET, compute_visibility_map
+
+SUNSET_FIELDS = (
+    'date', 'sunset_local', 'moon_alt', 'geocentric_elongation', 'moon_age_hours',
+    'moon_lag_time', 'moonset_local', 'irnu',
+)
+MAP_FIELDS = ('date', 'resolution', 'cells', 'met', 'met_percent', 'no_sunset')
+
+# Days solved together in one vectorized pass
+CHUNK_DAYS = 7
+# Longest accepted ranges, in days
+MAX_SUNSET_DAYS = 366
+MAX_MAP_DAYS = 7
+# Finest H3 resolution of the visibility sweep (resolution 3 is about 41,000 cells)
+MAX_MAP_RESOLUTION = 3
+
+OUTSIDE_LUNATION_TABLE = "These dates are outside the range of the lunation table."
+
+
+def parse_date(text):
+    """Reads a YYYY-MM-DD date typed by the user."""
+    try:
+        return date.fromisoformat(str(text).strip())
+    except ValueError:
+        raise ReportError("Dates must be written as YYYY-MM-DD.") from None
+
+
+def current_hijri_year():
+    """Today's year in the tabular Hijri calendar."""
+    julian_day = date.today().toordinal() + 1721424.5
+    return int((julian_day - ISLAMIC_EPOCH) * 30 // 10631) + 1
+
+
+def date_range(start, end, max_days):
+    """Every date from `start` through `end` (datetime.date)."""
+    days = (end - start).days + 1
+    if days < 1:
+        raise ReportError("The end date is before the start date.")
+    if days > max_days:
+        raise ReportError(f"Please choose a range of at most {max_days} days.")
+    return [start + timedelta(days=i) for i in range(days)]
+
+
+def _cached_first(keys, compute):
+    """Yields the cached value of each key, then computes the others with `compute(missing keys)`,
+    which yields (key, value) pairs, caching each as it arrives."""
+    missing = []
+    for key in keys:
+        value = row_cache.get(key)
+        if value is None:
+            missing.append(key)
+        else:
+            yield value
+    if missing:
+        for key, value in compute(missing):
+            row_cache.put(key, value)
+            yield value
+
+
+def _sunset_chunk(latitude, longitude, days):
+    """Sunset rows of one place on a few local dates, in one vectorized pass."""
+    ts = get_timescale()
+    table = get_lunation_table()
+    zone = resolve_timezone(latitude, longitude)
+    offsets = [local_utc_offset_hours(zone, datetime(day.year, day.month, day.day, 12)) if zone
+               else round(longitude / 15) for day in days]
+
+    sunset_tt = sun_events(latitude, longitude, [day.year for day in days], [day.month for day in days],
+                           [day.day for day in days])
+    sets = ~np.isnan(sunset_tt)
+    if not all(table.covers(tt) for tt in sunset_tt[sets]):
+        raise ReportError(OUTSIDE_LUNATION_TABLE)
+    data = {}
+    if sets.any():
+        n = int(sets.sum())
+        data = compute_moon_sun_pairs(np.full(n, float(latitude)), np.full(n, float(longitude)),
+                                      ts.tt_jd(sunset_tt[sets]), moonsets=True)
+        data['utc'] = ts.tt_jd(sunset_tt[sets]).utc_datetime()
+        data['new_moon'] = table.new_moons[np.searchsorted(table.new_moons, sunset_tt[sets], side='right') - 1]
+
+    j = 0
+    for k, day in enumerate(days):
+        row = dict.fromkeys(SUNSET_FIELDS)
+        row['date'] = day.isoformat()
+        if sets[k]:
+            moonset_tt = data['moonset_tt'][j]
+            row.update({
+                'sunset_local': (data['utc'][j] + timedelta(hours=offsets[k])).strftime('%Y-%m-%d %H:%M'),
+                'moon_alt': round(float(data['moon_alt'][j]), 4),
+                'geocentric_elongation': round(float(data['geocentric_elongation'][j]), 4),
+                'moon_age_hours': round(float(sunset_tt[k] - data['new_moon'][j]) * 24, 4),
+                'moon_lag_time': None if np.isnan(moonset_tt) else round(float(data['moon_lag_time'][j]), 4),
+                'moonset_local': None if np.isnan(moonset_tt) else (
+                    ts.tt_jd(moonset_tt).utc_datetime() + timedelta(hours=offsets[k])).strftime('%Y-%m-%d %H:%M'),
+                'irnu': bool(meets_irnu_criteria(data['moon_alt'][j], data['geocentric_elongation'][j])),
+            })
+            j += 1
+        yield row
+
+
+def sunset_rows(latitude, longitude, start, end):
+    """Yields the sunset row of every local date from `start` through `end` at one place.
+
+    Rows are dicts of SUNSET_FIELDS; cached rows come first, then the others
+    CHUNK_DAYS at a time, so they are not in date order.
+    """
+    cell = location_key(latitude, longitude)
+
+    def compute(keys):
+        for i in range(0, len(keys), CHUNK_DAYS):
+            chunk = keys[i:i + CHUNK_DAYS]
+            rows = _sunset_chunk(latitude, longitude, [date.fromordinal(key[2]) for key in chunk])
+            yield from zip(chunk, rows)
+
+    keys = [('sunset', cell, day.toordinal()) for day in date_range(start, end, MAX_SUNSET_DAYS)]
+    # Before any row, so that dates past the ephemeris are reported as such
+    check_year(start.year)
+    check_year(end.year)
+    yield from _cached_first(keys, compute)
+
+
+def hijri_year_rows(label, latitude, longitude, hijri_year, first_month=1, last_month=12):
+    """Yields the month-start row (hilal_table.TABLE_FIELDS) of each month of a Hijri year at one place."""
+    first_year, last_year = hijri_year_range()
+    if not first_year <= hijri_year <= last_year:
+        raise ReportError(OUTSIDE_LUNATION_TABLE)
+    cell = location_key(latitude, longitude)
+
+    def compute(keys):
+        for key in keys:
+            yield key, month_rows([(label, latitude, longitude)], hijri_year, key[3])[0]
+
+    keys = [('hijri', cell, hijri_year, month) for month in range(first_month, last_month + 1)]
+    for row in _cached_first(keys, compute):
+        yield dict(row, place=label)
+
+
+def map_summary(day, resolution, grid):
+    """One MAP_FIELDS row: how many cells of a visibility grid meet the IRNU criteria."""
+    met = int((grid['status'] == MET).sum())
+    return {'date': day.isoformat(), 'resolution': resolution, 'cells': len(grid), 'met': met,
+            'met_percent': round(100 * met / len(grid), 2),
+            'no_sunset': int((grid['status'] == NO_SUNSET).sum())}
+
+
+def visibility_sweep(start, end, resolution=2):
+    """Yields (date, resolution, grid) for the global visibility map of every evening from `start` through `end`.
+
+    All the evenings are first mapped at H3 resolution 0, then again at each
+    finer resolution up to `resolution`, so a rough answer for the whole
+    range comes quickly.
+    """
+    if not 0 <= resolution <= MAX_MAP_RESOLUTION:
+        raise ReportError(f"The map resolution must be between 0 and {MAX_MAP_RESOLUTION}.")
+    days = date_range(start, end, MAX_MAP_DAYS)
+    check_year(start.year)
+    check_year(end.year)
+    for level in range(resolution + 1):
+        def compute(keys):
+            for key in keys:
+                day = date.fromordinal(key[1])
+                # In this process: concurrent requests are bounded by the interface's queue
+                yield key, (day, level, compute_visibility_map(day.year, day.month, day.day, level, workers=1))
+
+        yield from _cached_first([('map', day.toordinal(), level) for day in days], compute)
@@ -0,0 +1,176 @@
+"""Out-of-process rendering pool.
+
+Matplotlib's pyplot state is not thread-safe, so rendering inline in the
+request handlers serializes concurrent users behind the plotting.  Instead
+the handlers send the plot's plain numeric inputs to a pool of worker
+processes, each of which keeps its own warmed-up Matplotlib backend and
+cached background, and get the encoded image bytes back.  The workers'
+spans (background, drawing, encoding) are sent back with each image and
+merged into this process's metrics.  If a worker dies, the broken pool is
+shut down and a new one started for the next render.  Workers are started
+and warmed up as soon as the pool is created, with this module rather than
+the server's script as their main module, so they do not load the interface.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
+
+from metrics import enable_metrics, merge_snapshot, metrics_enabled, observe, take_snapshot
+
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+
+# Kept here rather than in visualization so the server can list the profiles
+# without importing Matplotlib, which only the workers need
+RENDER_PROFILES = {
+    # Original quality, for exports
+    'export': {'dpi': 300, 'format': 'png', 'reuse_figure': False, 'savefig': {'bbox_inches': 'tight'}},
+    # Lightweight, for interactive use
+    'fast': {'dpi': 72, 'format': 'jpeg', 'reuse_figure': True, 'savefig': {'pil_kwargs': {'quality': 85}}},
+}
+
+_lock = threading.Lock()
+_pool = None
+# One no-op job per worker of the current pool, done once every worker has warmed up
+_ready = []
+
+logger = logging.getLogger(__name__)
+
+
+def _warm_up():
+    """Worker initializer: loads Matplotlib and the background, and renders each profile once."""
+    from visualization import create_visualization
+    for profile in RENDER_PROFILES:
+        create_visualization(5.0, -0.8, 280.0, 273.0, 10.0, 2025, 1, 1, 0, 0, "Yes", "sunset", profile)
+
+
+def _no_op():
+    """Worker: does nothing; finishes once the worker has started and warmed up."""
+
+
+def _render(args, profile, metrics_on=False):
+    """Worker: renders one plot and returns its encoded bytes (None on failure), with the metrics recorded."""
+    from visualization import create_visualization
+    enable_metrics(metrics_on)
+    buf = create_visualization(*args, profile=profile)
+    return None if buf is None else buf.getvalue(), take_snapshot()
+
+
+def _render_map(grid, title, metrics_on=False):
+    """Worker: draws a visibility_map grid and returns the PNG bytes, with the metrics recorded."""
+    from visibility_map import render_visibility_map
+    enable_metrics(metrics_on)
+    buf = io.BytesIO()
+    render_visibility_map(grid, title, buf)
+    return buf.getvalue(), take_snapshot()
+
+
+@contextmanager
+def _light_main():
+    """Makes the processes spawned meanwhile import this module as their main module.
+
+    A spawned process first re-imports the parent's main module, which for
+    app.py would load Gradio, pandas and the calculator into every worker.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def get_pool(wait_ready=False):
+    """Returns the shared pool, starting and warming up all its workers when it is created.
+
+    With `wait_ready`, returns only once every worker is ready, e.g. at server startup.
+    """
+    global _pool, _ready
+    with _lock:
+        if _pool is None:
+            # Spawn rather than fork: the server process runs threads
+            pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_warm_up)
+            with _light_main():
+                # While no worker is idle, every submission starts another one
+                _ready = [pool.submit(_no_op) for _ in range(RENDER_WORKERS)]
+            _pool = pool
+        pool, ready = _pool, _ready
+    if wait_ready:
+        wait(ready)
+    return pool
+
+
+def _discard_pool(pool):
+    """Shuts a broken pool down, so that the next get_pool() starts a new one."""
+    global _pool
+    with _lock:
+        if _pool is not pool:
+            # Already replaced by another thread
+            return
+        _pool = None
+    logger.warning("Render pool broken or shut down, starting a new one")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(stage, function, *args):
+    """Runs a worker function in the pool; returns a Future of its result, with the worker's metrics merged.
+
+    Never raises: if the pool cannot take the job, the error is set on the Future.
+    """
+    future = Future()
+    start = time.perf_counter()
+
+    def unpack(pool, done):
+        # Time spent queued and rendering, as seen by the server
+        observe('stage_seconds', time.perf_counter() - start, stage=stage)
+        if done.exception() is not None:
+            if isinstance(done.exception(), BrokenProcessPool):
+                _discard_pool(pool)
+            future.set_exception(done.exception())
+            return
+        data, snapshot = done.result()
+        merge_snapshot(snapshot)
+        future.set_result(data)
+
+    for _ in range(2):
+        pool = get_pool()
+        try:
+            pool.submit(function, *args, metrics_enabled()).add_done_callback(partial(unpack, pool))
+            return future
+        except (BrokenProcessPool, RuntimeError) as e:
+            # The pool broke, or was shut down, since its last job: retry once in a new one
+            _discard_pool(pool)
+            error = e
+    future.set_exception(error)
+    return future
+
+
+def render_image(plot_args, profile='export'):
+    """Queues a create_visualization call and returns a Future of the encoded image bytes."""
+    # Send plain Python values, not NumPy scalars
+    plot_args = tuple(float(x) if hasattr(x, 'dtype') else x for x in plot_args)
+    return _submit('render', _render, plot_args, profile)
+
+
+def render_map(grid, title):
+    """Queues a visibility map drawing and returns a Future of the PNG bytes."""
+    return _submit('render_map', _render_map, grid, title)
+
+
+def open_image(future):
+    """Waits for a render and decodes it for display, or returns None if it failed."""
+    from PIL import Image
+    try:
+        data = future.result()
+    except Exception as e:
+        logger.exception(f"Visualization error: {str(e)}")
+        return None
+    return None if data is None else Image.open(io.BytesIO(data))
@@ -0,0 +1,149 @@
+"""Two-level cache for computed reports, range report rows and rendered images.
+
+Entries live in an in-memory LRU bounded by total size and, optionally, in
+an on-disk SQLite store that survives restarts and is shared by processes.
+Entries may carry a time-to-live, which is used for "current" mode results.
+Hits and misses are counted per level.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import h3
+
+from metrics import register_collector
+
+# H3 resolution used to quantize observer locations (cells of about 0.1 km^2)
+LOCATION_CELL_RESOLUTION = 9
+# How long a "current" mode result stays valid, in seconds
+CURRENT_TTL_SECONDS = 60
+# Directory of the on-disk stores; leave unset for memory-only caching
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+
+
+class ResultCache:
+    """LRU cache of picklable values bounded by `max_bytes`, optionally backed by SQLite."""
+
+    def __init__(self, name, max_bytes, disk_max_bytes=None, disk_dir=RESULT_CACHE_DIR):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes or 16 * max_bytes
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()  # key -> (pickled value, expiry time or None)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk = sqlite3.connect(os.path.join(disk_dir, f"{name}.sqlite"), check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "key TEXT PRIMARY KEY, value BLOB, expires REAL, last_used REAL)")
+        register_collector(self._samples)
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None."""
+        key = repr(key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                data, expires = entry
+                if expires is None or expires > now:
+                    self._entries.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return pickle.loads(data)
+                self._remove(key)
+
+            if self._disk is not None:
+                row = self._disk.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    with self._disk:
+                        self._disk.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+                    self._insert(key, row[0], row[1])
+                    self.counters['disk_hits'] += 1
+                    return pickle.loads(row[0])
+
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, value, ttl=None):
+        """Stores `value` under `key`, expiring after `ttl` seconds if given."""
+        key = repr(key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._insert(key, data, expires)
+            if self._disk is not None:
+                with self._disk:
+                    self._disk.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                       (key, data, expires, time.time()))
+                    self._evict_disk()
+
+    def stats(self):
+        """Returns the hit/miss counters and the current memory usage."""
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes)
+
+    def _samples(self):
+        """The stats as metric samples, labelled with the cache name."""
+        stats = self.stats()
+        labels = {'cache': self.name}
+        samples = [(f'cache_{name}_total', labels, stats[name]) for name in self.counters]
+        return samples + [('cache_entries', labels, stats['entries']), ('cache_bytes', labels, stats['bytes'])]
+
+    def _insert(self, key, data, expires):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (data, expires)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counters['evictions'] += 1
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def _evict_disk(self):
+        """Drops expired entries, then the least recently used ones beyond disk_max_bytes."""
+        self._disk.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+        total = self._disk.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+        if total > self.disk_max_bytes:
+            rows = self._disk.execute("SELECT key, LENGTH(value) FROM entries ORDER BY last_used").fetchall()
+            for key, size in rows:
+                if total <= self.disk_max_bytes:
+                    break
+                self._disk.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+
+
+def location_key(latitude, longitude):
+    """Quantizes a location to its H3 cell."""
+    return h3.geo_to_h3(latitude, longitude, LOCATION_CELL_RESOLUTION)
+
+
+def report_key(latitude, longitude, time_option, year, month, day, hour, minute):
+    """Cache key of the numeric results for a location, mode and date (and time, in specific mode)."""
+    mode = time_option.lower()
+    if mode == "current":
+        return (location_key(latitude, longitude), mode)
+    if mode == "sunset":
+        return (location_key(latitude, longitude), mode, int(year), int(month), int(day))
+    return (location_key(latitude, longitude), mode, int(year), int(month), int(day), int(hour), int(minute))
+
+
+def report_ttl(time_option):
+    """Time-to-live of a result: "current" mode results expire, others never change."""
+    return CURRENT_TTL_SECONDS if time_option.lower() == "current" else None
+
+
+# Computed numeric results, rendered images, and the finished rows (and map grids) of range reports
+report_cache = ResultCache('reports', max_bytes=16 * 1024 * 1024)
+image_cache = ResultCache('images', max_bytes=64 * 1024 * 1024)
+row_cache = ResultCache('rows', max_bytes=64 * 1024 * 1024)
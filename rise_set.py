@@ -0,0 +1,282 @@
+"""Vectorized rising and setting times of the Sun and the Moon.
+
+Every event is solved for arrays of observers (and dates) in one pass: an
+initial guess comes from spherical astronomy (a low-precision solar position
+for the Sun, the Moon's current hour angle and declination for the Moon),
+and a few Newton steps on the topocentric altitude refine it, each step
+being a single vectorized ephemeris evaluation.  The rate of change of the
+altitude is taken from the azimuth, dh/dt = w cos(lat) sin(az), so no extra
+evaluations are needed for the derivative.  Moon events Newton misses, such
+as grazing ones at high latitudes, are found again by sampling the altitude
+and bisecting the first horizon crossing.
+
+Sunsets and sunrises can also be looked up through a cache keyed by H3 cell
+and date.
+"""
+import threading
+from collections import OrderedDict
+from datetime import date as calendar_date
+
+import h3
+import numpy as np
+from skyfield.api import Topos
+
+from apparent_series import AU_KM, horizontal, observer_frame
+from ephemeris_store import get_ephemeris, get_timescale
+from metrics import count
+
+# Sun's altitude at sunset: refraction plus the Sun's semi-diameter, as in almanac.sunrise_sunset
+SUNSET_ALTITUDE = -0.8333
+# Refraction at the horizon; the Moon's semi-diameter is added from its distance
+REFRACTION_AT_HORIZON = -0.5667
+MOON_RADIUS_KM = 1737.4
+
+# Rates of change of the hour angle, in degrees per day
+SUN_HOUR_ANGLE_RATE = 360.0
+MOON_HOUR_ANGLE_RATE = 347.8
+
+# Newton iterations, the largest single step (days) and the convergence tolerance (days)
+SUN_NEWTON_STEPS = 3
+MOON_NEWTON_STEPS = 4
+MAX_STEP_DAYS = 1 / 24
+TOLERANCE_DAYS = 1 / 86400
+
+# Fallback search: altitude samples up to BRACKET_SPAN_DAYS ahead (the Newton guess
+# reaches about 1.035 days), hourly, then every 15 minutes where that finds nothing
+BRACKET_STEPS_DAYS = (1 / 24, 15 / 1440)
+BRACKET_SPAN_DAYS = 1.05
+# Between hourly samples the altitude strays from a straight line by at most about
+# 0.5 degrees, so only places sampled closer than this to the horizon are sampled again
+GRAZING_MARGIN_DEGREES = 1.0
+
+# H3 resolution and size of the (cell, date) event cache
+EVENT_CELL_RESOLUTION = 9
+EVENT_CACHE_SIZE = 65536
+
+_lock = threading.Lock()
+_event_cache = OrderedDict()
+
+
+def _observer(latitudes, longitudes, elevations):
+    eph = get_ephemeris()
+    return eph['earth'] + Topos(latitude_degrees=latitudes, longitude_degrees=longitudes,
+                                elevation_m=elevations)
+
+
+def _solar_position(jd):
+    """Low-precision apparent solar right ascension and declination (degrees) and
+    equation of time (hours), from the Astronomical Almanac's approximate formulas."""
+    n = jd - 2451545.0
+    mean_longitude = 280.460 + 0.9856474 * n
+    g = np.radians(357.528 + 0.9856003 * n)
+    ecliptic_longitude = np.radians(mean_longitude + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    ra = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude)))
+    dec = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude)))
+    equation_of_time = ((mean_longitude - ra + 180) % 360 - 180) / 15
+    return ra, dec, equation_of_time
+
+
+def _hour_angle_at_altitude(latitudes, declinations, altitude):
+    """Hour angle (degrees, 0-180) at which a body of the given declination reaches `altitude`.
+
+    NaN where it stays above or below that altitude all day.  Values just
+    outside the valid range are clipped, and left for Newton to confirm.
+    """
+    lat, dec = np.radians(latitudes), np.radians(declinations)
+    cos_h0 = (np.sin(np.radians(altitude)) - np.sin(lat) * np.sin(dec)) / (np.cos(lat) * np.cos(dec))
+    cos_h0 = np.where(np.abs(cos_h0) <= 1.02, np.clip(cos_h0, -1, 1), np.nan)
+    return np.degrees(np.arccos(cos_h0))
+
+
+def _altaz(body, latitudes, longitudes, elevations, t, series=None):
+    """Topocentric altitude and azimuth (degrees) and distance (km) of `body`."""
+    if series is not None and series.covers(t.tt):
+        position, rotation = observer_frame(latitudes, longitudes, elevations, t, series)
+        alt, az, distance = horizontal(series.geocentric(body, t.tt) - position, rotation)
+        count('positions_total', len(latitudes), body=body, source='series')
+        return alt, az, distance * AU_KM
+    count('positions_total', len(latitudes), body=body, source='ephemeris')
+    observer = _observer(latitudes, longitudes, elevations)
+    alt, az, distance = observer.at(t).observe(get_ephemeris()[body]).apparent().altaz()
+    return alt.degrees, az.degrees, distance.km
+
+
+def moon_horizon(distance_km):
+    """Altitude (degrees) of the Moon's center at moonrise and moonset, from its distance."""
+    return REFRACTION_AT_HORIZON - np.degrees(np.arcsin(MOON_RADIUS_KM / distance_km))
+
+
+def _height(body, latitudes, longitudes, elevations, tt, series=None):
+    """Altitude above the body's rising and setting altitude (degrees) at TT Julian dates `tt`."""
+    alt, _, distance_km = _altaz(body, latitudes, longitudes, elevations, get_timescale().tt_jd(tt), series)
+    return alt - (SUNSET_ALTITUDE if body == 'sun' else moon_horizon(distance_km))
+
+
+def _refine(body, latitudes, longitudes, elevations, tt, rising, steps, rate, series=None):
+    """Newton iterations on the topocentric altitude, starting at TT Julian dates `tt`.
+
+    Returns the refined dates, NaN where the iteration did not converge onto
+    an event of the requested kind.
+    """
+    ts = get_timescale()
+    cos_lat = np.cos(np.radians(latitudes))
+    step = np.full(len(tt), np.inf)
+    slope = np.zeros(len(tt))
+    for _ in range(steps):
+        alt, az, distance_km = _altaz(body, latitudes, longitudes, elevations, ts.tt_jd(tt), series)
+        horizon = SUNSET_ALTITUDE if body == 'sun' else moon_horizon(distance_km)
+        slope = rate * cos_lat * np.sin(np.radians(az))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.clip((alt - horizon) / slope, -MAX_STEP_DAYS, MAX_STEP_DAYS)
+        tt = tt - np.nan_to_num(step)
+    converged = (np.abs(step) < TOLERANCE_DAYS) & ((slope > 0) if rising else (slope < 0))
+    return np.where(converged, tt, np.nan)
+
+
+def _bracket(body, latitudes, longitudes, elevations, start_tt, rising, series=None):
+    """First rising (or setting) after `start_tt` from altitude samples, refined by bisection.
+
+    Slower than _refine but does not depend on a first guess; NaN where the
+    samples show no crossing within BRACKET_SPAN_DAYS.  A dip shorter than
+    the finest sampling step can be missed.
+    """
+    event = np.full(len(start_tt), np.nan)
+    todo = np.arange(len(start_tt))
+    for step_days in BRACKET_STEPS_DAYS:
+        if not len(todo):
+            break
+        offsets = np.arange(0, BRACKET_SPAN_DAYS + step_days, step_days)
+        samples = len(offsets)
+        tt = start_tt[todo, None] + offsets[None, :]
+        height = _height(body, np.repeat(latitudes[todo], samples), np.repeat(longitudes[todo], samples),
+                         np.repeat(elevations[todo], samples), tt.ravel(), series).reshape(tt.shape)
+        up = height > 0
+        crossing = (~up[:, :-1] & up[:, 1:]) if rising else (up[:, :-1] & ~up[:, 1:])
+        found = crossing.any(axis=1)
+        if found.any():
+            first = crossing[found].argmax(axis=1)
+            low, high = tt[found, first], tt[found, first + 1]
+            rows = todo[found]
+            for _ in range(int(np.ceil(np.log2(step_days / TOLERANCE_DAYS)))):
+                middle = (low + high) / 2
+                # Still before the crossing while the body is on its starting side of the horizon
+                before = (_height(body, latitudes[rows], longitudes[rows], elevations[rows], middle,
+                                  series) > 0) != rising
+                low, high = np.where(before, middle, low), np.where(before, high, middle)
+            event[rows] = (low + high) / 2
+        todo = todo[~found & (np.abs(height).min(axis=1) < GRAZING_MARGIN_DEGREES)]
+    return event
+
+
+def sun_events(latitudes, longitudes, year, month, day, rising=False, elevations=None, series=None):
+    """Returns the TT Julian date of each location's sunset (or sunrise) on its local date.
+
+    `year`, `month` and `day` may be scalars or arrays matching the
+    locations, so many places and dates are solved together.  The local date
+    runs from local mean midnight to midnight.  NaN where the Sun does not
+    set (or rise) that day.  An apparent_series.ApparentSeries may be passed
+    to take the Sun's positions from it.
+    """
+    ts = get_timescale()
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    latitudes, longitudes, year, month, day = np.broadcast_arrays(latitudes, longitudes, year, month, day)
+    elevations = np.zeros_like(latitudes) if elevations is None else np.broadcast_to(elevations, latitudes.shape)
+
+    # Initial guess: transit from the equation of time, then the hour angle of sunset
+    noon = 12 - longitudes / 15
+    midnight_jd = ts.utc(year, month, day).ut1
+    _, dec, equation_of_time = _solar_position(midnight_jd + noon / 24)
+    hour_angle = _hour_angle_at_altitude(latitudes, dec, SUNSET_ALTITUDE)
+    hours = noon - equation_of_time + (-hour_angle if rising else hour_angle) / 15
+
+    event = np.full(latitudes.shape, np.nan)
+    found = ~np.isnan(hours)
+    if found.any():
+        guess = ts.utc(year[found], month[found], day[found], hours[found]).tt
+        event[found] = _refine('sun', latitudes[found], longitudes[found], elevations[found], guess,
+                               rising, SUN_NEWTON_STEPS, SUN_HOUR_ANGLE_RATE, series)
+    return event
+
+
+def moon_events(latitudes, longitudes, start_tt, rising=False, elevations=None, moon_alt=None, moon_az=None,
+                series=None):
+    """Returns the TT Julian date of the first moonset (or moonrise) after `start_tt` at each location.
+
+    `start_tt` is a scalar or one date per location.  The Moon's topocentric
+    altitude and azimuth at `start_tt` (degrees) may be passed in when they
+    are already known, e.g. from a batch at sunset; otherwise they are
+    computed.  NaN where no event follows within about a day.
+    """
+    ts = get_timescale()
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    latitudes, longitudes, start_tt = np.broadcast_arrays(latitudes, longitudes, start_tt)
+    elevations = np.zeros_like(latitudes) if elevations is None else np.broadcast_to(elevations, latitudes.shape)
+    if moon_alt is None or moon_az is None:
+        moon_alt, moon_az, _ = _altaz('moon', latitudes, longitudes, elevations, ts.tt_jd(start_tt), series)
+
+    # Hour angle and declination at the start, from the altitude and azimuth
+    lat, alt, az = np.radians(latitudes), np.radians(moon_alt), np.radians(moon_az)
+    dec = np.arcsin(np.sin(lat) * np.sin(alt) + np.cos(lat) * np.cos(alt) * np.cos(az))
+    hour_angle = np.degrees(np.arctan2(-np.sin(az) * np.cos(alt),
+                                       np.cos(lat) * np.sin(alt) - np.sin(lat) * np.cos(alt) * np.cos(az)))
+
+    # Initial guess: the time for the hour angle to reach that of the horizon crossing
+    event_hour_angle = _hour_angle_at_altitude(latitudes, np.degrees(dec), SUNSET_ALTITUDE)
+    if rising:
+        event_hour_angle = -event_hour_angle
+    guess = start_tt + ((event_hour_angle - hour_angle) % 360) / MOON_HOUR_ANGLE_RATE
+
+    event = np.full(latitudes.shape, np.nan)
+    found = ~np.isnan(guess)
+    if found.any():
+        event[found] = _refine('moon', latitudes[found], longitudes[found], elevations[found], guess[found],
+                               rising, MOON_NEWTON_STEPS, MOON_HOUR_ANGLE_RATE, series)
+    # Newton may step back before the start when the Moon is right at the horizon
+    event = np.where(event >= start_tt - TOLERANCE_DAYS, event, np.nan)
+
+    # Search again where there was no guess or Newton did not converge (grazing events)
+    missed = np.isnan(event)
+    if missed.any():
+        event[missed] = _bracket('moon', latitudes[missed], longitudes[missed], elevations[missed],
+                                 start_tt[missed], rising, series)
+    return event
+
+
+def cached_sun_events(latitudes, longitudes, year, month, day, rising=False, series=None):
+    """Like sun_events, but reuses results per (H3 cell, date, series).
+
+    Locations are quantized to EVENT_CELL_RESOLUTION cells (about 0.1 km^2,
+    a fraction of a second of sunset time); only the misses are solved,
+    together in one vectorized call.  Results from different series (or none)
+    are kept apart.
+    """
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    latitudes, longitudes, year, month, day = np.broadcast_arrays(latitudes, longitudes, year, month, day)
+    keys = [(h3.geo_to_h3(lat, lon, EVENT_CELL_RESOLUTION),
+             calendar_date(int(y), int(m), int(d)).toordinal(), rising, series)
+            for lat, lon, y, m, d in zip(latitudes, longitudes, year, month, day)]
+
+    event = np.empty(latitudes.shape)
+    missing = []
+    with _lock:
+        for i, key in enumerate(keys):
+            if key in _event_cache:
+                _event_cache.move_to_end(key)
+                event[i] = _event_cache[key]
+            else:
+                missing.append(i)
+    count('sun_event_cache_total', len(keys) - len(missing), result='hit')
+    count('sun_event_cache_total', len(missing), result='miss')
+    if missing:
+        event[missing] = sun_events(latitudes[missing], longitudes[missing], year[missing],
+                                    month[missing], day[missing], rising, series=series)
+        with _lock:
+            for i in missing:
+                _event_cache[keys[i]] = event[i]
+            while len(_event_cache) > EVENT_CACHE_SIZE:
+                _event_cache.popitem(last=False)
+    return event
@@ -0,0 +1,174 @@
+"""Precomputed "current time" snapshots for frequently requested places.
+
+The Moon and Sun move little within a minute, yet every "current" report
+used to be computed from scratch.  A background thread instead evaluates,
+every SNAPSHOT_INTERVAL seconds and in one batch_engine pass, the positions
+of the places listed in SNAPSHOT_PLACES and of the places requested most
+often, at the refresh instant and 2 x SNAPSHOT_INTERVAL later.  A "current"
+request for one of those places (same H3 cell as result_cache uses) is then
+answered by interpolating linearly between the two instants, which costs no
+ephemeris work; requests elsewhere, or outside the window when a refresh is
+late, are computed as before.
+
+Requests are counted per H3 cell, with counts decaying at every refresh, so
+the set of popular places follows the traffic.
+"""
+import logging
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from batch_engine import BATCH_FIELDS, compute_moon_sun_batch
+from ephemeris_store import get_timescale
+from metrics import count, register_collector
+from result_cache import location_key
+from rise_set import moon_horizon
+
+# Seconds between two refreshes; each snapshot covers twice that
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 30))
+# Number of most requested places kept fresh, besides those of SNAPSHOT_PLACES
+SNAPSHOT_TOP_PLACES = int(os.environ.get('SNAPSHOT_TOP_PLACES', 50))
+# File of places always kept fresh: one city name or LAT,LON[,LABEL] per line
+SNAPSHOT_PLACES = os.environ.get('SNAPSHOT_PLACES')
+# Factor applied to the request counts at every refresh (a half-life of about 35 minutes at 30 s)
+QUERY_DECAY = 0.99
+# Most places whose requests are counted
+QUERY_LOG_SIZE = 10000
+
+# Fields interpolated as angles wrapping at 360 degrees, and at 24 hours
+AZIMUTH_FIELDS = ('moon_az', 'sun_az')
+HOUR_FIELDS = ('moon_ra', 'sun_ra')
+
+Snapshot = namedtuple('Snapshot', 'tt0 tt1 index data')
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_queries = {}  # cell -> [count, latitude, longitude]
+_fixed_places = None
+_snapshot = None
+
+
+def record_query(latitude, longitude):
+    """Counts a request for a place, to find the most requested ones."""
+    cell = location_key(latitude, longitude)
+    with _lock:
+        entry = _queries.get(cell)
+        if entry is None:
+            if len(_queries) >= QUERY_LOG_SIZE:
+                # Forget the least requested half
+                for stale in sorted(_queries, key=lambda key: _queries[key][0])[:QUERY_LOG_SIZE // 2]:
+                    del _queries[stale]
+            entry = _queries[cell] = [0, float(latitude), float(longitude)]
+        entry[0] += 1
+
+
+def _load_fixed_places():
+    """The places of SNAPSHOT_PLACES as (latitude, longitude), read once."""
+    global _fixed_places
+    if _fixed_places is None:
+        places = []
+        if SNAPSHOT_PLACES:
+            from hilal_table import read_places_file, resolve_places
+            cities, coords = read_places_file(SNAPSHOT_PLACES)
+            for city in cities:
+                try:
+                    places += resolve_places([city])
+                except ValueError as e:
+                    logger.warning(f"Snapshot place skipped: {str(e)}")
+            places += resolve_places(coords=coords)
+        _fixed_places = [(latitude, longitude) for _, latitude, longitude in places]
+    return _fixed_places
+
+
+def snapshot_places():
+    """The places to refresh, keyed by H3 cell: the fixed ones, then the most requested."""
+    places = {location_key(latitude, longitude): (latitude, longitude) for latitude, longitude in _load_fixed_places()}
+    with _lock:
+        popular = sorted(_queries.items(), key=lambda item: -item[1][0])[:SNAPSHOT_TOP_PLACES]
+        for entry in _queries.values():
+            entry[0] *= QUERY_DECAY
+    for cell, (_, latitude, longitude) in popular:
+        places.setdefault(cell, (latitude, longitude))
+    return places
+
+
+def refresh_snapshot(interval=SNAPSHOT_INTERVAL):
+    """Computes and publishes a new snapshot covering the next 2 x `interval` seconds."""
+    global _snapshot
+    places = snapshot_places()
+    if not places:
+        return None
+    ts = get_timescale()
+    tt0 = ts.now().tt
+    tt1 = tt0 + 2 * interval / 86400
+    latitudes, longitudes = np.array(list(places.values())).T
+    data = compute_moon_sun_batch(latitudes, longitudes, ts.tt_jd(np.array([tt0, tt1])), moonsets=True)
+    index = {cell: i for i, cell in enumerate(places)}
+    _snapshot = Snapshot(tt0, tt1, index, {name: np.array(values) for name, values in data.items()})
+    return _snapshot
+
+
+def current_values(latitude, longitude, tt):
+    """Interpolated BATCH_FIELDS values for a place at TT Julian date `tt`, or None if no snapshot covers it."""
+    snapshot = _snapshot
+    i = None if snapshot is None else snapshot.index.get(location_key(latitude, longitude))
+    if i is None or not snapshot.tt0 <= tt <= snapshot.tt1:
+        count('current_snapshot_total', result='miss')
+        return None
+    count('current_snapshot_total', result='hit')
+
+    fraction = (tt - snapshot.tt0) / (snapshot.tt1 - snapshot.tt0)
+    values = {}
+    for name in BATCH_FIELDS:
+        start, end = snapshot.data[name][i]
+        if name in AZIMUTH_FIELDS:
+            values[name] = (start + fraction * ((end - start + 180) % 360 - 180)) % 360
+        elif name in HOUR_FIELDS:
+            values[name] = (start + fraction * ((end - start + 12) % 24 - 12)) % 24
+        else:
+            values[name] = start + fraction * (end - start)
+    values['azimuth_diff'] = values['moon_az'] - values['sun_az']
+
+    # The moonset nearest this instant, as batch_engine defines it: the next one while the Moon is up
+    moonsets = snapshot.data['moonset_tt'][i]
+    if values['moon_alt'] > moon_horizon(values['moon_distance']):
+        moonsets = moonsets[moonsets >= tt]
+        moonset_tt = moonsets.min() if len(moonsets) else np.nan
+    else:
+        moonsets = moonsets[moonsets <= tt]
+        moonset_tt = moonsets.max() if len(moonsets) else np.nan
+    values['moonset_tt'] = moonset_tt
+    values['moon_lag_time'] = (moonset_tt - tt) * 24
+    values['lama_hilal'] = np.maximum(values['moon_lag_time'], 0)
+    return values
+
+
+def start_snapshot_refresher(interval=SNAPSHOT_INTERVAL):
+    """Refreshes the snapshot every `interval` seconds in a daemon thread; set the returned Event to stop it."""
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                refresh_snapshot(interval)
+            except Exception as e:
+                logger.exception(f"Snapshot refresh failed: {str(e)}")
+            if stop.wait(interval):
+                return
+
+    threading.Thread(target=run, name='snapshot-refresher', daemon=True).start()
+    return stop
+
+
+def _snapshot_samples():
+    snapshot = _snapshot
+    if snapshot is None:
+        return []
+    return [('snapshot_places', {}, len(snapshot.index)),
+            ('snapshot_age_seconds', {}, (get_timescale().now().tt - snapshot.tt0) * 86400)]
+
+
+register_collector(_snapshot_samples)
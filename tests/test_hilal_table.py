@@ -0,0 +1,34 @@
+import argparse
+
+import pytest
+
+from hilal_table import _parse_month, check_month_covered, hijri_months, main
+
+
+@pytest.mark.parametrize('text', ['1446-13', '1446-0', '1446-x'])
+def test_parse_month_rejects_invalid_months(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        _parse_month(text)
+
+
+def test_parse_month():
+    assert _parse_month('1446-9') == (1446, 9)
+    assert _parse_month('1446') == (1446, 1)
+
+
+@pytest.mark.parametrize('argv', [['1446-13', '1447-1'], ['1446-0', '1446-1']])
+def test_cli_rejects_invalid_months(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        main(argv + ['--coords=21.42,39.83'])
+    assert exit_info.value.code == 2
+
+
+@pytest.mark.parametrize('month', [0, 13])
+def test_check_month_covered_rejects_invalid_months(month):
+    with pytest.raises(ValueError):
+        check_month_covered(1446, month)
+
+
+def test_hijri_months_crosses_years():
+    assert list(hijri_months((1446, 11), (1447, 2))) == [(1446, 11), (1446, 12), (1447, 1), (1447, 2)]
+    assert list(hijri_months((1447, 1), (1446, 12))) == []
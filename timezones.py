@@ -0,0 +1,93 @@
+"""Process-wide timezone resolution with date-correct UTC offsets.
+
+A single TimezoneFinder is shared by every request, and the zone found for a
+location is cached per H3 cell, so nearby requests reuse it.  The UTC offset
+is looked up for the instant being computed, using each zone's DST
+transitions, which are extracted once per zone and searched with bisection.
+pytz lists transitions only up to 2037; later instants in zones that still
+observe DST are resolved with zoneinfo, which applies the zone's POSIX rule.
+"""
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+import h3
+from pytz import timezone
+
+from metrics import register_collector
+
+# H3 resolution used to quantize locations (cells of about 0.7 km^2)
+TIMEZONE_CELL_RESOLUTION = 8
+
+_lock = threading.Lock()
+_finder = None
+
+
+def _get_finder():
+    global _finder
+    with _lock:
+        if _finder is None:
+            from timezonefinder import TimezoneFinder
+            _finder = TimezoneFinder()
+        return _finder
+
+
+@lru_cache(maxsize=65536)
+def _timezone_of_cell(cell):
+    latitude, longitude = h3.h3_to_geo(cell)
+    finder = _get_finder()
+    with _lock:
+        return finder.timezone_at(lng=longitude, lat=latitude)
+
+
+def _cache_samples():
+    info = _timezone_of_cell.cache_info()
+    labels = {'cache': 'timezones'}
+    return [('cache_memory_hits_total', labels, info.hits), ('cache_misses_total', labels, info.misses),
+            ('cache_entries', labels, info.currsize)]
+
+
+register_collector(_cache_samples)
+
+
+def resolve_timezone(latitude, longitude):
+    """Returns the timezone name at a location, or None if there is none."""
+    return _timezone_of_cell(h3.geo_to_h3(latitude, longitude, TIMEZONE_CELL_RESOLUTION))
+
+
+@lru_cache(maxsize=None)
+def _zone_transitions(zone_name):
+    """Returns the UTC instants at which the zone's offset changes and the offsets (hours) from each."""
+    tz = timezone(zone_name)
+    # pytz keeps the transitions of DST zones in these (private) lists
+    if hasattr(tz, '_utc_transition_times'):
+        offsets = [info[0].total_seconds() / 3600 for info in tz._transition_info]
+        return tz._utc_transition_times, offsets
+    return [datetime.min], [tz.utcoffset(datetime(2000, 1, 1)).total_seconds() / 3600]
+
+
+def utc_offset_hours(zone_name, utc_datetime):
+    """Returns the zone's UTC offset in hours at a (naive or aware) UTC datetime."""
+    transitions, offsets = _zone_transitions(zone_name)
+    utc_datetime = utc_datetime.replace(tzinfo=None)
+    if len(transitions) > 1 and utc_datetime >= transitions[-1]:
+        # Past the end of pytz's table, which may stop in the middle of recurring DST
+        return _rule_offset_hours(zone_name, utc_datetime)
+    i = bisect_right(transitions, utc_datetime) - 1
+    return offsets[max(i, 0)]
+
+
+def _rule_offset_hours(zone_name, utc_datetime):
+    """Returns the zone's UTC offset in hours from its zoneinfo rule."""
+    local = utc_datetime.replace(tzinfo=dt_timezone.utc).astimezone(ZoneInfo(zone_name))
+    return local.utcoffset().total_seconds() / 3600
+
+
+def local_utc_offset_hours(zone_name, local_datetime):
+    """Returns the zone's UTC offset in hours for a naive local datetime."""
+    local_datetime = local_datetime.replace(tzinfo=None)
+    offset = utc_offset_hours(zone_name, local_datetime)
+    # Refine once with the offset in force at the corresponding UTC instant
+    return utc_offset_hours(zone_name, local_datetime - timedelta(hours=offset))
@@ -0,0 +1,155 @@
+"""Global IRNU visibility map on an H3 grid.
+
+Covers the globe (or a bounding box) with H3 cells, finds the local sunset of
+every cell on a given date, computes the Moon's altitude and the geocentric
+elongation at that sunset, and classifies each cell against the IRNU
+criteria.  Sunsets and positions are evaluated as vectors across cells, and
+chunks of cells are spread over a process pool.
+
+    python visibility_map.py 2025 3 29 --resolution 3 --output map.npy --image map.png
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import h3
+import numpy as np
+
+from apparent_series import load_apparent_series
+from batch_engine import compute_moon_sun_pairs, meets_irnu_criteria
+from ephemeris_store import get_timescale
+from rise_set import sun_events
+
+# Cell status values
+NO_SUNSET, NOT_MET, MET = -1, 0, 1
+
+CELL_DTYPE = np.dtype([
+    ('cell', '<u8'), ('lat', '<f4'), ('lon', '<f4'), ('sunset_tt', '<f8'),
+    ('moon_alt', '<f4'), ('geocentric_elongation', '<f4'), ('status', 'i1'),
+])
+
+CHUNK_SIZE = 2000
+
+
+def grid_cells(resolution, bbox=None):
+    """Returns the H3 cells at `resolution` covering `bbox` (lat_min, lat_max, lon_min, lon_max), or the globe."""
+    if bbox is None:
+        cells = set()
+        for base_cell in h3.get_res0_indexes():
+            cells.update(h3.h3_to_children(base_cell, resolution))
+    else:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        polygon = {'type': 'Polygon', 'coordinates': [[
+            (lat_min, lon_min), (lat_min, lon_max), (lat_max, lon_max), (lat_max, lon_min)]]}
+        cells = h3.polyfill(polygon, resolution)
+    return sorted(cells)
+
+
+def _evaluate_chunk(args):
+    """Worker: sunset, Moon altitude and elongation for one chunk of cell centers."""
+    latitudes, longitudes, year, month, day, series_path = args
+    ts = get_timescale()
+    series = load_apparent_series(series_path) if series_path else None
+    sunset_tt = sun_events(latitudes, longitudes, year, month, day, series=series)
+    sets = ~np.isnan(sunset_tt)
+
+    moon_alt = np.full(len(latitudes), np.nan)
+    elongation = np.full(len(latitudes), np.nan)
+    if sets.any():
+        data = compute_moon_sun_pairs(latitudes[sets], longitudes[sets], ts.tt_jd(sunset_tt[sets]),
+                                      series=series)
+        moon_alt[sets] = data['moon_alt']
+        elongation[sets] = data['geocentric_elongation']
+    return sunset_tt, moon_alt, elongation
+
+
+def compute_visibility_map(year, month, day, resolution=2, bbox=None, workers=None, series_path=None):
+    """Classifies every H3 cell against the IRNU criteria at its sunset on the given date.
+
+    With `series_path`, positions come from that apparent_series file.
+    Returns a structured array of CELL_DTYPE, one row per cell.
+    """
+    cells = grid_cells(resolution, bbox)
+    centers = np.array([h3.h3_to_geo(cell) for cell in cells]).reshape(-1, 2)
+    latitudes, longitudes = centers[:, 0], centers[:, 1]
+
+    chunks = [(latitudes[i:i + CHUNK_SIZE], longitudes[i:i + CHUNK_SIZE], year, month, day, series_path)
+              for i in range(0, len(cells), CHUNK_SIZE)]
+    if workers == 1 or len(chunks) == 1:
+        results = list(map(_evaluate_chunk, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_evaluate_chunk, chunks))
+
+    grid = np.empty(len(cells), dtype=CELL_DTYPE)
+    grid['cell'] = [h3.string_to_h3(cell) for cell in cells]
+    grid['lat'] = latitudes
+    grid['lon'] = longitudes
+    if results:
+        grid['sunset_tt'], grid['moon_alt'], grid['geocentric_elongation'] = (
+            np.concatenate(parts) for parts in zip(*results))
+    grid['status'] = np.where(np.isnan(grid['sunset_tt']), NO_SUNSET,
+                              np.where(meets_irnu_criteria(grid['moon_alt'], grid['geocentric_elongation']),
+                                       MET, NOT_MET))
+    return grid
+
+
+def render_visibility_map(grid, title, path):
+    """Draws the classified cells on a longitude/latitude map and saves it to `path`."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PolyCollection
+
+    colors = {NO_SUNSET: '#555555', NOT_MET: '#c0392b', MET: '#27ae60'}
+    polygons, facecolors = [], []
+    for row in grid:
+        boundary = np.array(h3.h3_to_geo_boundary(h3.h3_to_string(int(row['cell']))))
+        lons = boundary[:, 1]
+        # Keep cells that straddle the antimeridian on the same side as their center
+        if lons.max() - lons.min() > 180:
+            lons = np.where(lons < 0, lons + 360, lons) if row['lon'] > 0 else np.where(lons > 0, lons - 360, lons)
+        polygons.append(np.column_stack([lons, boundary[:, 0]]))
+        facecolors.append(colors[int(row['status'])])
+
+    fig, ax = plt.subplots(figsize=(14, 7))
+    ax.add_collection(PolyCollection(polygons, facecolors=facecolors, edgecolors='none'))
+    ax.set_xlim(grid['lon'].min() - 2, grid['lon'].max() + 2)
+    ax.set_ylim(grid['lat'].min() - 2, grid['lat'].max() + 2)
+    ax.set_xlabel('Longitude (°)')
+    ax.set_ylabel('Latitude (°)')
+    ax.set_title(title, fontsize=14, weight='bold')
+    ax.grid(True, linestyle='--', alpha=0.4)
+    handles = [plt.Rectangle((0, 0), 1, 1, color=colors[MET]),
+               plt.Rectangle((0, 0), 1, 1, color=colors[NOT_MET]),
+               plt.Rectangle((0, 0), 1, 1, color=colors[NO_SUNSET])]
+    ax.legend(handles, ['Memenuhi kriteria IRNU', 'Tidak memenuhi kriteria IRNU', 'Tidak ada ghurub'],
+              loc='lower left')
+    fig.savefig(path, bbox_inches='tight', dpi=150)
+    plt.close(fig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="IRNU visibility map at local sunset on an H3 grid.")
+    parser.add_argument('year', type=int)
+    parser.add_argument('month', type=int)
+    parser.add_argument('day', type=int)
+    parser.add_argument('--resolution', type=int, default=2, help="H3 resolution (default 2)")
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'),
+                        help="limit the map to a bounding box")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--series', help="apparent_series.py file to take positions from (faster)")
+    parser.add_argument('--output', default='visibility_map.npy', help="per-cell array (.npy)")
+    parser.add_argument('--image', default='visibility_map.png', help="rendered map")
+    args = parser.parse_args(argv)
+
+    grid = compute_visibility_map(args.year, args.month, args.day, args.resolution,
+                                  args.bbox, args.workers, args.series)
+    np.save(args.output, grid)
+    title = f'Visibilitas Hilal IRNU saat Ghurub {args.year}-{args.month:02d}-{args.day:02d}'
+    render_visibility_map(grid, title, args.image)
+    met = int((grid['status'] == MET).sum())
+    print(f"{len(grid)} cells, {met} meet the IRNU criteria -> {args.output}, {args.image}")
+
+
+if __name__ == '__main__':
+    main()
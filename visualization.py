@@ -0,0 +1,189 @@
+"""Visualization of the Moon and Sun positions over a sky background.
+
+The background photo is fetched once (or read from a bundled file), decoded
+and downscaled to the output size, and kept in memory.  Two render profiles
+are available: "export" keeps the original high quality PNG, and "fast" is a
+lightweight profile for interactive use that renders at a lower DPI into a
+reused Figure and encodes JPEG.
+"""
+import io
+import logging
+import os
+import threading
+import urllib.request
+from functools import lru_cache
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
+from PIL import Image
+
+from metrics import span
+from render_pool import RENDER_PROFILES
+
+BACKGROUND_URL = 'https://images.unsplash.com/photo-1535914728398-fcc06686536c?q=80&w=2954&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D'
+BACKGROUND_PATH = os.environ.get('BACKGROUND_IMAGE',
+                                 os.path.join(os.path.dirname(__file__), 'data', 'background.jpg'))
+
+FIGURE_SIZE = (12, 6)
+
+_figures = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def _load_background():
+    """Decodes the background photo, downloading and saving it on first use."""
+    if not os.path.exists(BACKGROUND_PATH):
+        with urllib.request.urlopen(BACKGROUND_URL) as url:
+            data = url.read()
+        try:
+            with open(BACKGROUND_PATH, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Could not save background image: {str(e)}")
+        image = Image.open(io.BytesIO(data))
+    else:
+        image = Image.open(BACKGROUND_PATH)
+    return image.convert('RGB')
+
+
+@lru_cache(maxsize=4)
+def _background(width, height):
+    """Returns the background as an array no larger than the plot area in pixels."""
+    image = _load_background()
+    size = (min(width, image.width), min(height, image.height))
+    return np.asarray(image.resize(size, Image.LANCZOS))
+
+
+def _reused_figure(dpi):
+    """Returns this thread's Figure and Axes for `dpi`, cleared for a new plot."""
+    cache = _figures.__dict__
+    if dpi not in cache:
+        fig = Figure(figsize=FIGURE_SIZE, dpi=dpi)
+        ax = fig.add_subplot()
+        fig.subplots_adjust(left=0.07, right=0.98, bottom=0.1, top=0.92)
+        cache[dpi] = (fig, ax)
+    fig, ax = cache[dpi]
+    ax.clear()
+    return fig, ax
+
+
+def _draw(ax, bg_img, moon_alt, sun_alt, moon_azimuth, sun_az, geocentric_elongation, year, month, day, hour, minute, day29, time_option):
+    """Draws the Moon, the Sun, the horizon and (on day 29) the elongation lines on `ax`."""
+    # Dynamically adjust background extent (Further Enhanced)
+    bg_extent = [
+        min(moon_azimuth, sun_az) - 15,
+        max(moon_azimuth, sun_az) + 15,
+        min(0, moon_alt, sun_alt) - 7,
+        max(0, moon_alt, sun_alt) + 7
+    ]
+
+
+    # Plot background
+    ax.imshow(bg_img, extent=bg_extent, aspect='auto', alpha=0.7)
+
+    # Plot Moon position
+    ax.plot(moon_azimuth, moon_alt, 'o', color='yellow', markersize=12, label='Bulan')
+    # ax.annotate('Bulan', (moon_azimuth, moon_alt),
+    #            textcoords="offset points", xytext=(10, 10),
+    #            ha='center', color='yellow', fontsize=12, weight='bold')
+
+    # Plot Sun position
+    ax.plot(sun_az, sun_alt, 'o', color='red', markersize=14, label='Matahari')  # Removed .degrees from sun_az
+    # ax.annotate('Matahari', (sun_az, sun_alt),  # Removed .degrees from sun_az
+    #            textcoords="offset points", xytext=(10, 10),
+    #            ha='center', color='red', fontsize=12, weight='bold')
+
+    # Horizon Line
+    ax.axhline(0, color='red', linestyle='-', linewidth=2)
+
+
+    # --- Geocentric Elongation Lines ---
+    if day29 == "Yes":  # Check if day29_input is "Yes"
+        # Line connecting Sun to Moon (existing)
+        ax.plot([sun_az, moon_azimuth], [sun_alt, moon_alt], '--',
+                color='white', linewidth=1.5, label="Sudut Elongasi")
+        ax.text((sun_az + moon_azimuth) / 2, (sun_alt + moon_alt) / 2 + 1,
+                f"{geocentric_elongation:.2f}°", color='white',
+                ha='right', va='center', fontsize=10)
+
+        # Line connecting Earth to Moon (new)
+        # Calculate the endpoint coordinates
+        earth_line_end_x = moon_azimuth  # Earth azimuth = Moon azimuth
+        earth_line_end_y = 0  # Earth altitude = 0 (horizon)
+
+        # Draw the earth line
+        ax.plot([moon_azimuth, earth_line_end_x], [moon_alt, earth_line_end_y], '--',
+                color='white', linewidth=1.5)
+        ax.text(moon_azimuth, moon_alt / 2 + 1, " ", color='lightblue', ha='center', va='center', fontsize=10)  # Placeholder for degree label
+
+        # Add helping lines with annotations
+        ax.axhline(3, color='orange', linestyle='--', label='Ketinggian Minimal Imkan')
+
+
+
+    # Set plot limits to match background extent
+    ax.set_xlim(bg_extent[0], bg_extent[1])
+    ax.set_ylim(bg_extent[2], bg_extent[3])
+
+    # Labels and styling
+    ax.set_xlabel('Azimuth (°)', fontsize=14, weight='bold', color='white')
+    ax.set_ylabel('Ketinggian/Altitude (°)', fontsize=14, weight='bold', color='white')
+
+    # Set the plot title based on time_option
+    if time_option.lower() == "current":
+        title = f'Moon and Sun Position (Current Time)'
+    elif time_option.lower() == "sunset":
+        title = f'Hilal saat Ghurub (Sunset)'
+        # title = f'Hilal saat Ghurub/'{time_label} {time_display.strftime('%Y-%m-%d %H:%M')}
+    else: # specific or any other case
+        title = f'Moon and Sun Position ({year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d})'
+
+    ax.set_title(title, fontsize=16, weight='bold', color='white')
+
+
+    # Customize grid and legend
+    ax.grid(True, linestyle='--', alpha=0.4, color='white')
+    ax.legend(facecolor='black', edgecolor='white', labelcolor='white')
+
+    # Style the axis labels
+    ax.tick_params(colors='white')
+    for spine in ax.spines.values():
+        spine.set_color('white')
+
+
+def create_visualization(moon_alt, sun_alt, moon_azimuth, sun_az, geocentric_elongation, year, month, day, hour, minute, day29, time_option, profile='export'):
+    """Creates the visualization plot with background image, encoded per the render profile."""
+    try:
+        settings = RENDER_PROFILES[profile]
+        dpi = settings['dpi']
+        # Downloads and decodes the photo on first use
+        with span("background"):
+            bg_img = _background(FIGURE_SIZE[0] * dpi, FIGURE_SIZE[1] * dpi)
+
+        if settings['reuse_figure']:
+            fig, ax = _reused_figure(dpi)
+        else:
+            fig, ax = plt.subplots(figsize=FIGURE_SIZE)
+
+        with span("draw"):
+            _draw(ax, bg_img, moon_alt, sun_alt, moon_azimuth, sun_az, geocentric_elongation,
+                  year, month, day, hour, minute, day29, time_option)
+
+        # Save plot to buffer with black background
+        buf = io.BytesIO()
+        with span("encode"):
+            fig.savefig(buf, format=settings['format'], dpi=dpi,
+                        facecolor='black', edgecolor='none', **settings['savefig'])
+        buf.seek(0)
+        if not settings['reuse_figure']:
+            plt.close(fig)
+
+        return buf
+
+    except Exception as e:
+        logger.exception(f"Visualization error: {str(e)}")